@@ -1,5 +1,5 @@
 from main.circuit import*
-from main.matrix import Matrix, tensor
+from main.matrix import Matrix, SparseMatrix, tensor
 from math import pi, sqrt
 
 #Grovers algorithm finds an x for which the function f: {0,1,...,2^n -1}-->{0,1} is 1.
@@ -10,23 +10,12 @@ x=13
 n=6
 c=Circuit(n+1)
 
-#define the matrix that computes f
-F=Matrix.Zero(2**(n+1))
-for i in range(2**(n+1)):
-    for j in range(2**(n+1)):
-        if i==j and i!=2*x and i!=(2*x)+1:
-            F[i][j]=1
-        elif i==2*x and j==(2*x)+1:
-            F[i][j]=1
-        elif i==(2*x)+1 and j==2*x:
-            F[i][j]=1
+#define the matrix that computes f. It only swaps the basis states 2x and 2x+1, so it is stored sparsely
+columns=list(range(2**(n+1)))
+columns[2*x], columns[2*x+1]=2*x+1, 2*x
+F=SparseMatrix(range(2**(n+1)), columns, [1]*(2**(n+1)), (2**(n+1),2**(n+1)))
              
-U=Matrix.Zero(2**(n))
-for i in range(2**(n)):
-    if i==0:
-        U[i][i]=1
-    else:
-        U[i][i]=-1
+U=SparseMatrix(range(2**n), range(2**n), [1]+[-1]*(2**n-1), (2**n,2**n))
          
 U=tensor([U,Matrix.Id(2)])
 
@@ -51,7 +51,7 @@ def Shor(N):
                     
             c=Circuit(q)
             
-            U=Matrix.Zero(2**q)
+            entries=set()
             for i in range(0,2**q):
                 for j in range(0,2**q):
                     i1=binary(i,0,q//2,q)
@@ -61,8 +61,8 @@ def Shor(N):
                     check=True
     
                     if int(i2,2)==0 and i1==j1 and a**(int(i1,2)) % N==int(j2,2):                
-                        U[i][j]=1 
-                        U[j][i]=1
+                        entries.add((i,j))
+                        entries.add((j,i))
                         break
                     elif i2=='1'*(q//2) and i1==j1:
                         l=binary(a**(int(i1,2)) % N,0,q//2,q//2)
@@ -71,16 +71,14 @@ def Shor(N):
                                 check=False
                                 break
                         if check:
-                            U[i][j]=1  
-                            U[j][i]=1
+                            entries.add((i,j))
+                            entries.add((j,i))
                             break
-            count=0
-            for row in U.rows:
-                if row==[0]*(2**q):
-                    U[count][count]=1
-                    count+=1
-                    continue
-                count+=1      
+            #rows of U without an entry act as the identity
+            filled={i for i, j in entries}
+            entries|={(i,i) for i in range(2**q) if i not in filled}
+            rows, columns=zip(*entries)
+            U=SparseMatrix(rows, columns, [1]*len(entries), (2**q,2**q))
                 
             h=c.add_gate(H,q//2) 
             c.add_wires(c, [i for i in range(0,q//2)], h, [i for i in range(0,q//2)])
@@ -96,11 +94,12 @@ def Shor(N):
             in_v=[0]*(q//2)+[1]*(q//2)
             r=0
             while r==0:
-                seznam=(c.run(in_v))[0:q//2]
-                stri=''
-                for i in seznam:
-                    stri+=str(i)
-                r=int(stri,2)
+                #simulate once and look through a batch of measurements for a nonzero result
+                for outcome in c.sample(in_v,32):
+                    #the first q//2 output bits hold the measured value
+                    r=int(outcome)>>(q-q//2)
+                    if r!=0:
+                        break
                 
             r=r/(2**(q//2))
             r=approx(r,2**(q//2))
@@ -8,7 +8,7 @@ q=(len(bin(N))-2)*2
                     
 c=Circuit(q)
 
-U=Matrix.Zero(2**q)
+entries=set()
 for i in range(0,2**q):
     for j in range(0,2**q):
         i1=binary(i,0,q//2,q)
@@ -18,8 +18,8 @@ for i in range(0,2**q):
         check=True
 
         if int(i2,2)==0 and i1==j1 and a**(int(i1,2)) % N==int(j2,2):                
-            U[i][j]=1 
-            U[j][i]=1
+            entries.add((i,j))
+            entries.add((j,i))
             break
         elif i2=='1'*(q//2) and i1==j1:
             l=binary(a**(int(i1,2)) % N,0,q//2,q//2)
@@ -28,16 +28,14 @@ for i in range(0,2**q):
                     check=False
                     break
             if check:
-                U[i][j]=1  
-                U[j][i]=1
+                entries.add((i,j))
+                entries.add((j,i))
                 break
-count=0
-for row in U.rows:
-    if row==[0]*(2**q):
-        U[count][count]=1
-        count+=1
-        continue
-    count+=1      
+#rows of U without an entry act as the identity
+filled={i for i, j in entries}
+entries|={(i,i) for i in range(2**q) if i not in filled}
+rows, columns=zip(*entries)
+U=SparseMatrix(rows, columns, [1]*len(entries), (2**q,2**q))
     
 h=c.add_gate(H,q//2) 
 c.add_wires(c, [i for i in range(0,q//2)], h, [i for i in range(0,q//2)])
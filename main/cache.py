@@ -0,0 +1,110 @@
+from main.matrix import Matrix, SparseMatrix
+from collections import OrderedDict
+import hashlib
+import os
+import numpy as np
+
+# Memoization of the unitaries computed by Circuit.get_subcircuit. Circuits are identified by a
+# structural hash that only depends on the gate matrices and on how the gates are wired together, so
+# identical building blocks (an oracle, a diffusion step ...) share one entry regardless of the names
+# and uuids of their gates.
+
+
+# Returns a hex digest of the circuit's structure: its width, the matrix and qbit lanes of every gate
+# in topological order and the lanes carried by the outputs
+def structure_hash(circuit):
+    plan = circuit.compile()
+    h = hashlib.sha256()
+    h.update(b'circuit %d;' % len(circuit))
+    for instruction in plan.instructions:
+        h.update(('gate %s;' % (instruction.lanes,)).encode())
+        _update_matrix(h, instruction.matrix)
+    h.update(('output %s;' % (plan.output,)).encode())
+    return h.hexdigest()
+
+
+def _update_matrix(h, M):
+    if isinstance(M, SparseMatrix):
+        h.update(b'sparse %d %d;' % M.shape)
+        for array in (M.indptr, M.indices, M.values):
+            h.update(np.ascontiguousarray(array).tobytes())
+    else:
+        data = M.todense().data
+        h.update(b'dense %d %d;' % data.shape)
+        h.update(np.ascontiguousarray(data).tobytes())
+
+
+# Least recently used cache of unitaries (Matrix objects) keyed by structural hash. The entries kept in
+# memory are limited to max_bytes. If a directory is given, entries are also stored there as .npy files,
+# which are evicted the same way once they take up more than max_disk_bytes.
+class UnitaryCache(object):
+    def __init__(self, max_bytes=2**28, directory=None, max_disk_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.directory is not None and os.path.exists(self._path(key)))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    # Returns the cached unitary or None
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        if self.directory is not None and os.path.exists(self._path(key)):
+            path = self._path(key)
+            M = Matrix.from_array(np.load(path))
+            os.utime(path)
+            self._store(key, M)
+            self.hits += 1
+            return M
+
+        self.misses += 1
+        return None
+
+    def put(self, key, M):
+        self._store(key, M)
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            np.save(self._path(key), M.data)
+            self._evict_disk()
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def _store(self, key, M):
+        if key in self._entries:
+            self._size -= self._entries.pop(key).data.nbytes
+        if M.data.nbytes > self.max_bytes:
+            return
+        self._entries[key] = M
+        self._size += M.data.nbytes
+        while self._size > self.max_bytes:
+            key, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.data.nbytes
+
+    def _evict_disk(self):
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.npy')]
+        files.sort(key=os.path.getmtime)
+        size = sum(os.path.getsize(f) for f in files)
+        while files and size > self.max_disk_bytes:
+            f = files.pop(0)
+            size -= os.path.getsize(f)
+            os.remove(f)
+
+
+# The cache used by Circuit.get_subcircuit by default
+unitary_cache = UnitaryCache()
@@ -1,9 +1,15 @@
-from main.matrix import Matrix, tensor
-from collections import Counter
-from itertools import product
-from random import choices, choice, randint
+from main.matrix import Matrix, SparseMatrix, QubitPermutation, KronOperator, tensor, apply_to_axes, matrix_key
+from main import cost, tensornet, mps, stabilizer, classical, sparsestate, qmdd
+from main.cache import structure_hash, unitary_cache
+from collections import Counter, namedtuple
+from functools import lru_cache
+from heapq import heappush, heappop
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from random import choice, randint, getrandbits
 from math import log, modf
 from uuid import uuid4
+import numpy as np
 
 # Wire class
 class Wire(object):
@@ -16,6 +22,7 @@ class Wire(object):
         self.lind=lind
         self.rind=rind
         self.value = None
+        self.key = None
 
     def __str__(self):
         return str(self.left) + " --> " + str(self.right)
@@ -23,16 +30,172 @@ class Wire(object):
     def is_internal(self):
         return isinstance(self.left, Gate) and isinstance(self.right, Gate)
 
+# Measurement counts of a multi-shot run, keyed by the integer value of the measured output
+# (the first output is the most significant bit). Bit vectors are only decoded when asked for.
+class Counts(Counter):
+    def __init__(self, samples=(), size=None):
+        super().__init__()
+        self.size = size
+        if isinstance(samples, dict):
+            self.update(samples)
+            return
+        samples = np.asarray(samples)
+        if samples.dtype == object:
+            # outcomes of more than 63 bits are python integers
+            self.update(samples.tolist())
+            return
+        outcomes, counts = np.unique(samples.astype(np.int64), return_counts=True)
+        for outcome, count in zip(outcomes.tolist(), counts.tolist()):
+            self[outcome] = count
+
+    def copy(self):
+        return Counts(self, self.size)
+
+    @staticmethod
+    def decode(outcome, size):
+        return [(outcome >> (size - 1 - i)) & 1 for i in range(size)]
+
+    # Yields (output vector, count) pairs
+    def bitstrings(self):
+        for outcome, count in self.items():
+            yield Counts.decode(outcome, self.size), count
+
+# Draws shots samples (integers) from the output weights of a simulation
+def sample_weights(weights, shots, rng):
+    weights = np.asarray(weights, dtype=float)
+    cumulative = np.cumsum(weights)
+    cumulative /= cumulative[-1]
+    samples = np.searchsorted(cumulative, rng.random(shots), side='right')
+    return np.minimum(samples, len(weights) - 1)
+
+# Number of (output, internal assignment) pairs the Feynman method evaluates at once, and the amount of
+# work from which run_method1 spreads the blocks over multiple processes by default
+FEYNMAN_BLOCK = 2**16
+FEYNMAN_PARALLEL = 2**24
+
+# Computes the output probabilities of run_method1 for the outputs start, ..., stop-1. The paths of all
+# internal wire assignments are evaluated together in numpy arrays. This is a module level function so
+# that it can be sent to worker processes.
+def _feynman_block(spec, start, stop):
+    n, n_int, gates, fixed = spec
+    outputs = np.arange(start, stop, dtype=np.int64)[:, None]
+    chunk = min(2**n_int, FEYNMAN_BLOCK)
+
+    def bits(ports, assign):
+        index = 0
+        for kind, i in ports:
+            if kind == 0:
+                bit = i
+            elif kind == 1:
+                bit = (outputs >> (n-1-i)) & 1
+            else:
+                bit = (assign >> (n_int-1-i)) & 1
+            index = index*2 + bit
+        return index
+
+    sums = np.zeros(stop - start, dtype=np.complex128)
+    for a_start in range(0, 2**n_int, chunk):
+        assign = np.arange(a_start, a_start + chunk, dtype=np.int64)[None, :]
+        prod = np.ones((stop - start, chunk), dtype=np.complex128)
+        for matrix, in_ports, out_ports in gates:
+            prod = prod * matrix[bits(out_ports, assign), bits(in_ports, assign)]
+        sums += prod.sum(axis=1)
+
+    for i, value in fixed:
+        sums[((outputs[:, 0] >> (n-1-i)) & 1) != value] = 0
+
+    return np.abs(sums)**2
+
+# One step of a compiled circuit: the gate's matrix, the qbit lanes it acts on (a lane is identified by
+# the input index its qbit entered the circuit at) and the permutation that brings these lanes to the
+# top of the register for the matrix multiplication approach
+Instruction = namedtuple('Instruction', ['matrix', 'lanes', 'permutation'])
+
+# A compiled circuit: the instructions in topological order, the lane carried by every output, the
+# permutation that puts the lanes into output order and the programs the engines derive from it, by
+# engine. The programs live as long as the plan, so they are dropped when the circuit is modified.
+Plan = namedtuple('Plan', ['instructions', 'output', 'output_permutation', 'programs'])
+
+# Kahn's topological sort. Gate i has indegree[i] predecessors, successors(i) lists the gates after it.
+# Returns the gates in an order in which every gate comes after its predecessors; gates that are part of
+# (or come after) a cycle are left out. The gates are taken in their original order where possible, so
+# an order that is already valid does not change, and the work is linear in that case.
+def kahn_order(indegree, successors):
+    indegree = list(indegree)
+    order = []
+    for i in range(len(indegree)):
+        if indegree[i] != 0:
+            continue
+        # Numbering i may make gates ready that were skipped before, they are numbered right away
+        waiting = [i]
+        while waiting:
+            g = heappop(waiting)
+            order.append(g)
+            for h in successors(g):
+                indegree[h] -= 1
+                if indegree[h] == 0 and h < i:
+                    heappush(waiting, h)
+    return order
+
+# Largest number of gates _insert_edge reorders for a wire. Wires that would move more gates leave the
+# order stale, and it is rebuilt with kahn_order (in linear time) when it is needed next.
+REORDER_LIMIT = 256
+
 # Class for the entire circuit
 class Circuit(object):
     def __init__(self, size):
         self.input = [None] * size
         self.output = [None] * size
-        self.gates = []
-        self.ordered_gates = []
-        self.wires = []
+
+        # Gates and wires by their key, an integer that identifies them within the circuit and never
+        # changes. The lists returned by the gates and wires properties are built from these when needed.
+        self._gates = {}
+        self._wires = {}
+        self._keys = 0
+        self._gate_list = None
+        self._wire_list = None
 
         self.cls_ids = Counter()
+        self._plan = None
+
+        # Topological order maintained while the circuit is edited (see _insert_edge): the priority of
+        # every gate by key, the wires left out of the order because they close a cycle, whether the gate
+        # list is sorted by priority and whether the order has to be rebuilt first
+        self._order = {}
+        self._next = 0
+        self._cyclic = set()
+        self._sorted = True
+        self._stale = False
+
+    # The compiled plan and the gate and wire lists are not saved. Circuits pickled before the
+    # registries existed store plain lists of gates and wires, they get keys and a topological order here.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_plan'] = None
+        state['_gate_list'] = None
+        state['_wire_list'] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('_plan', None)
+        state.setdefault('_stale', False)
+        state.pop('ordered_gates', None)
+        gates = state.pop('gates', None)
+        wires = state.pop('wires', None)
+        self.__dict__.update(state)
+        if gates is not None:
+            self._gates = {}
+            self._wires = {}
+            self._keys = 0
+            self._gate_list = None
+            self._wire_list = None
+            for g in gates:
+                g.key = self._new_key()
+                self._gates[g.key] = g
+            for w in wires:
+                w.key = self._new_key()
+                self._wires[w.key] = w
+            self._rebuild_order()
 
     def __len__(self):
         return len(self.input)
@@ -40,14 +203,48 @@ class Circuit(object):
     def __iter__(self):
         return iter(self.gates)
 
+    # The gates, in topological order after sort() and in the order they were added otherwise
+    @property
+    def gates(self):
+        if self._gate_list is None:
+            if self._sorted:
+                self._gate_list = [self._gates[k] for k in sorted(self._gates, key=self._order.__getitem__)]
+            else:
+                self._gate_list = list(self._gates.values())
+        return self._gate_list
+
+    @property
+    def wires(self):
+        if self._wire_list is None:
+            self._wire_list = list(self._wires.values())
+        return self._wire_list
+
+    def _new_key(self):
+        self._keys += 1
+        return self._keys
+
+    # Whether component is a gate of this circuit
+    def _contains(self, component):
+        return isinstance(component, Gate) and self._gates.get(component.key) is component
+
     # Add component (gate or subcircuit - subcircuits are simply treated as gates everywhere else though)
     def add(self, component):
-        self.gates.append(component)
         if component.parent is not None:
             raise RuntimeError("Component is already added to a circuit.")
+        self._plan = None
+        self._register(component)
+        # A new gate has no wires yet, so it can go last
+        self._order[component.key] = self._next
+        self._next += 1
+        return component
+
+    def _register(self, component):
         self.cls_ids[component.name] += 1
         component.set_parent(self)
-        return component
+        component.key = self._new_key()
+        self._gates[component.key] = component
+        if self._gate_list is not None:
+            self._gate_list.append(component)
 
     # Add gate of type t and return the gate instance. Additional arguments will be passed to the constructor.
     def add_gate(self, t, *args):
@@ -57,19 +254,33 @@ class Circuit(object):
 
     # Create a wire from from_port-th output port of from_component to to_port-th input port of to_component
     def add_wire(self, from_component, from_port, to_component, to_port):
-        # Error checking
-        if from_component not in self.gates and from_component is not self:
+        self._check_wire(from_component, from_port, to_component, to_port)
+        self._plan = None
+        w = self._connect(from_component, from_port, to_component, to_port)
+        if isinstance(from_component, Gate) and isinstance(to_component, Gate):
+            self._insert_edge(w)
+
+        return w
+
+    # Error checking of add_wire. Gates in new (the ids of gates that are about to be added) are valid
+    # end points too.
+    def _check_wire(self, from_component, from_port, to_component, to_port, new=()):
+        if from_component is not self and not self._contains(from_component) and id(from_component) not in new:
             raise RuntimeError("Cannot add wire: Start point is not a valid component.")
-        if to_component not in self.gates and to_component is not self:
+        if to_component is not self and not self._contains(to_component) and id(to_component) not in new:
             raise RuntimeError("Cannot add wire: End point is not a valid component.")
         if from_port >= len(from_component):
             raise RuntimeError("Cannot add wire: {0} does not have {1} output ports.".format(from_component, from_port+1))
         if to_port >= len(to_component):
             raise RuntimeError("Cannot add wire: {0} does not have {1} input ports.".format(to_component, to_port+1))
 
-        # Add wire to the circuit
+    # Adds the wire to the circuit, without updating the topological order
+    def _connect(self, from_component, from_port, to_component, to_port):
         w = Wire(from_component, to_component, from_port, to_port)
-        self.wires.append(w)
+        w.key = self._new_key()
+        self._wires[w.key] = w
+        if self._wire_list is not None:
+            self._wire_list.append(w)
 
         # Add left and right component information to the wire
         # This differs slightly depending on whether the components are gates or the main circuit
@@ -77,9 +288,48 @@ class Circuit(object):
         to_ports = to_component.in_wires if isinstance(to_component, Gate) else to_component.output
         from_ports[from_port] = w
         to_ports[to_port] = w
-
         return w
 
+    # Adds many gates and wires at once. The wires are given as (from_component, from_port, to_component,
+    # to_port) tuples like the arguments of add_wire and may connect the new gates. Everything is checked
+    # before the circuit is changed and the topological order is computed once at the end. If the new
+    # wires would close a cycle, nothing is added and an error is raised. Unlike add_wire, the wires may
+    # only connect free ports, as the wires they replaced could not be restored.
+    def extend(self, gates=(), wires=()):
+        gates = list(gates)
+        wires = list(wires)
+        new = {id(g) for g in gates}
+        if len(new) != len(gates) or any(g.parent is not None for g in gates):
+            raise RuntimeError("Component is already added to a circuit.")
+        taken = set()
+        for from_component, from_port, to_component, to_port in wires:
+            self._check_wire(from_component, from_port, to_component, to_port, new=new)
+            from_ports = from_component.out_wires if isinstance(from_component, Gate) else from_component.input
+            to_ports = to_component.in_wires if isinstance(to_component, Gate) else to_component.output
+            for component, ports, port in ((from_component, from_ports, from_port), (to_component, to_ports, to_port)):
+                if ports[port] is not None or (id(ports), port) in taken:
+                    raise RuntimeError("Cannot add wire: port {0} of {1} is already connected.".format(port, component))
+                taken.add((id(ports), port))
+
+        self._plan = None
+        self._update_order()
+        cyclic = set(self._cyclic)
+        for g in gates:
+            self._register(g)
+        added = [self._connect(*wire) for wire in wires]
+        self._rebuild_order()
+
+        if not self._cyclic <= cyclic:
+            for w in added:
+                self.remove_wire(w)
+            for g in gates:
+                self.remove_gate(g)
+                self.cls_ids[g.name] -= 1
+                g.parent = None
+                g.key = None
+            raise RuntimeError("Cannot add gates: the circuit would contain a cycle.")
+        return gates, added
+
     # Helper method to create multiple wires at once
     # If from_ports or to_ports are empty, they default to all ports of the respective component
     def add_wires(self, from_component, from_ports, to_component, to_ports):
@@ -99,14 +349,22 @@ class Circuit(object):
     def remove_gate(self, g):
         if not g:
             return
-        for w in g.in_wires + g.out_wires:
+        if not self._contains(g):
+            raise RuntimeError("Cannot remove gate: {0} is not part of the circuit.".format(g))
+        for w in set(g.in_wires + g.out_wires):
             self.remove_wire(w)
-        self.gates.remove(g)
+        self._plan = None
+        del self._gates[g.key]
+        del self._order[g.key]
+        self._gate_list = None
 
     # Remove a single wire
     def remove_wire(self, w):
         if not w:
             return
+        if self._wires.get(w.key) is not w:
+            raise RuntimeError("Cannot remove wire: {0} is not part of the circuit.".format(w))
+        self._plan = None
         if w.left is self:
             self.input[w.lind] = None
         elif w.left:
@@ -115,75 +373,235 @@ class Circuit(object):
             w.right.output[w.rind] = None
         elif w.right:
             w.right.in_wires[w.rind] = None
-        self.wires.remove(w)
+        del self._wires[w.key]
+        self._wire_list = None
 
-    #this is the prefered method for implementing subcircuits. It compresses the whole circuit into
-    #one matrix and returns a gate associated with it
-    def get_subcircuit(self,name):
-        self.sort()
+        # Removing a wire can only break cycles, so the wires that closed one are tried again
+        self._cyclic.discard(w)
+        self._reinsert(list(self._cyclic))
+
+    #returns an equivalent circuit in which neighbouring gates (in topological order) are fused into
+    #single gates as long as they act on at most max_size qbits together. The fused gates' matrices are
+    #computed once here, so every simulation method has fewer, denser gates to apply.
+    def fuse(self, max_size=3):
+        plan=self.compile()
+
+        # Greedily collect runs of consecutive instructions whose lanes fit into max_size qbits
+        blocks=[]
+        for gate, instruction in zip(self.gates, plan.instructions):
+            if blocks:
+                lanes, members=blocks[-1]
+                union=lanes+[lane for lane in instruction.lanes if lane not in lanes]
+                if len(union)<=max_size:
+                    blocks[-1]=(union, members+[(gate, instruction)])
+                    continue
+            blocks.append((list(instruction.lanes), [(gate, instruction)]))
 
-        states=Matrix.Id(2**(len(self)))
+        c=Circuit(len(self))
+        last=[(c, lane) for lane in range(len(self))]
+        for lanes, members in blocks:
+            if len(members)==1:
+                gate=Gate(members[0][1].matrix, members[0][0].name, True)
+            else:
+                # Apply the members to the identity, one axis per lane of the block
+                m=len(lanes)
+                U=np.eye(2**m, dtype=np.complex128).reshape((2,)*m+(2**m,))
+                for member, instruction in members:
+                    U=apply_to_axes(instruction.matrix, U, [lanes.index(lane) for lane in instruction.lanes])
+                gate=Gate(Matrix.from_array(U.reshape(2**m, 2**m)), "Fused", True)
+            c.add(gate)
+            for port, lane in enumerate(lanes):
+                c.add_wire(last[lane][0], last[lane][1], gate, port)
+                last[lane]=(gate, port)
                 
-        for g_i in range(len(self.gates)):
-            gate=self.gates[g_i]
-            startqbits=[self.startqbit(g_i,i) for i in range(len(gate))]
-            permutation=[i for i in range(len(self))]
-            permuted=[]
-            for i in range(len(startqbits)):
-                x=permutation[i]
-                y=startqbits[i]
-                if x != y and x not in permuted:
-                    permutation[i]=y
-                    permutation[y]=x
-                    permuted.append(y)
+        for i, lane in enumerate(plan.output):
+            c.add_wire(last[lane][0], last[lane][1], c, i)
+            
+        return c
+
+    #this is the prefered method for implementing subcircuits. It compresses the whole circuit into
+    #one matrix and returns a gate associated with it. The matrices are memoized in cache (by default
+    #cache.unitary_cache) under the circuit's structure_hash(); pass cache=None to always recompute.
+    def get_subcircuit(self,name,cache=unitary_cache):
+        plan=self.compile()
+
+        if cache is not None:
+            key=self.structure_hash()
+            states=cache.get(key)
+            if states is not None:
+                return Gate(states.copy(),name,True)
+
+        states=self._evolve_matrix(plan, Matrix.Id(2**(len(self))))
+        gate=Gate(states,name)
+        if cache is not None:
+            cache.put(key, states.copy())
+            
+        return gate
+
+    #returns a hash of the circuit's gate matrices and wiring that does not depend on gate names or uuids
+    def structure_hash(self):
+        return structure_hash(self)
+
+    # Compiles the circuit into a flat list of instructions (see Plan). The plan is cached until the
+    # circuit is modified, so repeated runs skip the checks, the sort and the wire tracing.
+    def compile(self):
+        if self._plan is None:
+            self.sort()
+            #the lane of every wire is passed on from the inputs, gate by gate in topological order
+            #gates on the same lanes share their permutation
+            lanes={wire: i for i, wire in enumerate(self.input)}
+            permutations={}
+            #the views of a shared matrix (see _gate_matrix) become one matrix, so the engines that keep
+            #values per matrix compute them once per gate type
+            matrices={}
+            instructions=[]
+            for gate in self.gates:
+                startqbits=tuple(lanes[wire] for wire in gate.in_wires)
+                for wire, lane in zip(gate.out_wires, startqbits):
+                    lanes[wire]=lane
+                if startqbits not in permutations:
+                    permutations[startqbits]=self.gate_permutation(startqbits)
+                M=matrices.setdefault(matrix_key(gate.matrix), gate.matrix)
+                instructions.append(Instruction(M, startqbits, permutations[startqbits]))
+            startqbits=tuple(lanes[wire] for wire in self.output)
+            self._plan=Plan(tuple(instructions), startqbits, QubitPermutation(startqbits).inverse(), {})
             
-            P1=Matrix.Permutation(permutation)
-            P2=P1.getConjugate()
+        return self._plan
+
+    # Multiplies the columns of states (a 2^n x m Matrix) with the matrices of all instructions of
+    # the plan in order and permutes the result into output order
+    def _evolve_matrix(self, plan, states):
+        for instruction in plan.instructions:
+            P1=instruction.permutation
+            P2=P1.inverse()
             
-            if len(self)==len(gate):
-                M=gate.get_matrix()
+            if len(self)==len(instruction.lanes):
+                M=instruction.matrix
             else:
-                M=tensor([gate.get_matrix(),Matrix.Id(2**(len(self)-len(gate)))])
+                M=KronOperator([instruction.matrix,2**(len(self)-len(instruction.lanes))])
             
             states=P2*states
             states=M*states
             states=P1*states
             
-        startqbits=self.startqbits()
-        P1=Matrix.Permutation(startqbits)
-        P1.transpose()
-        states=P1*states
-            
-        return Gate(states,name)
-
-    # Helper function fot the topological sort
-    def visit(self, gate):
-        if gate.tempmarked:
-            raise RuntimeError("Cannot sort - the circuit contains a cycle.")
-        if not gate.marked:
-            gate.tempmarked = True
-            for wire in gate.out_wires:
-                if wire.right is not self:
-                    self.visit(wire.right)
-
-            gate.marked = True
-            gate.tempmarked = False
-            self.ordered_gates.insert(0, gate)
-
-    # Topological sort of the gate list
+        states=plan.output_permutation*states
+
+        return states
+
+    # Same as _evolve_matrix, but for a 2x...x2 state tensor with one axis per qbit (plus any
+    # number of trailing batch axes). Every gate is applied directly to the axes of its qbits.
+    def _evolve_tensor(self, plan, state):
+        for instruction in plan.instructions:
+            state=apply_to_axes(instruction.matrix, state, instruction.lanes)
+
+        #the i-th output carries the qbit that entered the circuit at input plan.output[i]
+        n=len(self)
+        return np.transpose(state, list(plan.output)+list(range(n, state.ndim)))
+
+    # Gates following g, and preceding g, through wires that are part of the topological order
+    def _successors(self, g):
+        return [w.right for w in g.out_wires
+                if w is not None and isinstance(w.right, Gate) and w not in self._cyclic]
+
+    def _predecessors(self, g):
+        return [w.left for w in g.in_wires
+                if w is not None and isinstance(w.left, Gate) and w not in self._cyclic]
+
+    # Adds the wire w between two gates to the topological order (Pearce-Kelly online algorithm).
+    # Nothing changes if its gates are already in the right order. Otherwise only the gates whose
+    # priorities lie between the two ends are searched and reordered. A wire that would close a cycle is
+    # left out of the order and remembered in self._cyclic. If more than limit gates would have to move,
+    # the search stops and the order is left stale (see _update_order), so that wires added against the
+    # order one by one do not take quadratic time.
+    def _insert_edge(self, w, limit=REORDER_LIMIT):
+        if self._stale:
+            return
+        order = self._order
+        x, y = w.left, w.right
+        lower, upper = order[y.key], order[x.key]
+        if lower > upper:
+            return
+
+        # Keys of the gates reachable from y that have to move after x
+        forward = {y.key}
+        stack = [y]
+        while stack:
+            for g in self._successors(stack.pop()):
+                if g is x:
+                    self._cyclic.add(w)
+                    return
+                if g.key not in forward and order[g.key] < upper:
+                    forward.add(g.key)
+                    stack.append(g)
+                    if limit is not None and len(forward) > limit:
+                        self._stale = True
+                        self._sorted = False
+                        return
+
+        # Keys of the gates x is reachable from that have to stay before y
+        backward = {x.key}
+        stack = [x]
+        while stack:
+            for g in self._predecessors(stack.pop()):
+                if g.key not in backward and order[g.key] > lower:
+                    backward.add(g.key)
+                    stack.append(g)
+                    if limit is not None and len(forward) + len(backward) > limit:
+                        self._stale = True
+                        self._sorted = False
+                        return
+
+        # Hand the priorities of both sets out again, the backward set first
+        moved = sorted(backward, key=order.__getitem__) + sorted(forward, key=order.__getitem__)
+        priorities = sorted(order[k] for k in moved)
+        for k, p in zip(moved, priorities):
+            order[k] = p
+        self._sorted = False
+
+    # Adds wires that are left out of the order (see _insert_edge) one at a time. The searches have to
+    # skip the wires that are still waiting, their gates may not be in order yet.
+    def _reinsert(self, wires, limit=REORDER_LIMIT):
+        for w in wires:
+            self._cyclic.discard(w)
+            self._insert_edge(w, limit)
+
+    # Rebuilds the order if _insert_edge left it stale
+    def _update_order(self):
+        if self._stale:
+            self._rebuild_order()
+
+    # Computes the topological order from scratch, for Circuit.extend and for circuits that were
+    # pickled without one. Gates on or behind a cycle are never numbered by kahn_order; they are
+    # numbered last and their wires are added one by one to find the wires that close the cycles.
+    def _rebuild_order(self):
+        self._stale = False
+        gates = list(self._gates.values())
+        position = {g.key: i for i, g in enumerate(gates)}
+        self._cyclic = set()
+        indegree = [sum(1 for w in g.in_wires if w is not None and isinstance(w.left, Gate)) for g in gates]
+        successors = lambda i: [position[h.key] for h in self._successors(gates[i])]
+
+        order = {gates[i].key: k for k, i in enumerate(kahn_order(indegree, successors))}
+
+        rest = [g for g in gates if g.key not in order]
+        for g in rest:
+            order[g.key] = len(order)
+        self._order = order
+        self._next = len(order)
+        self._sorted = True
+        self._gate_list = None
+        self._cyclic = {w for g in rest for w in g.in_wires if w is not None and isinstance(w.left, Gate)}
+        self._reinsert(list(self._cyclic), None)
+
+    # Topological sort of the gate list. The order is kept up to date while the circuit is edited, so
+    # the gate list only has to be rearranged if some wire changed it.
     def sort(self):
         if not self.check():
             raise RuntimeError("Cannot sort - please finish building the circuit first.")
 
-        for gate in self.gates:
-            if not gate.marked:
-                self.visit(gate)
-
-        self.gates = self.ordered_gates
-        self.ordered_gates = []
-        for gate in self.gates:
-            gate.marked=False
-            gate.tempmarked=False
+        if not self._sorted:
+            self._sorted = True
+            self._gate_list = None
 
     # Check the circuit is a proper quantum circuit
     def check(self):
@@ -197,95 +615,55 @@ class Circuit(object):
 
     # Check if the circuit contains a cycle
     def contains_cycle(self):
-        unchecked = {g for g in self}
-        while unchecked:
-            g = unchecked.pop()
-            if self._dfs(g, unchecked, set()):
-                return True
-        return False
-
-    def _dfs(self, g, unchecked, visited):
-        visited = visited | {g}
-        for w in g.out_wires:
-            if w is not None and w.right is not self:
-                if w.right in visited:
-                    return True
-                if w.right in unchecked:
-                    unchecked.remove(w.right)
-                    if self._dfs(w.right, unchecked, visited):
-                        return True
-        return False
+        self._update_order()
+        return bool(self._cyclic)
 
     # Run the circuit and return the computed output vector
     #method1 is the Feynman approach
-    def run_method1(self, in_v):
+    def run_method1(self, in_v, workers=None):
         
-        if len(in_v) != len(self):
-            raise RuntimeError("Input length does not match the size of the circuit.")
-        for i in in_v:
-            if i==0 or i==1:
-                pass
-            else:
-                raise RuntimeError("Invalid input - values must be 0 or 1.")
-                
-        for i in range(len(self)):
-            (self.input[i]).value=in_v[i]
-            
-        weights=[0 for i in range(2**(len(self)))]
+        self.check_input(in_v)
+        
+        # Every gate port reads either a fixed input value (kind 0), an output bit (kind 1) or an
+        # internal wire bit (kind 2), which lets the blocks compute matrix indices with bit arithmetic
         int_wires=self.get_internal_wires()
+        sources={}
+        for i in range(len(self)):
+            sources[self.input[i]]=(0, in_v[i])
+        for i in range(len(self)):
+            if self.output[i] not in sources:
+                sources[self.output[i]]=(1, i)
+        for k in range(len(int_wires)):
+            sources[int_wires[k]]=(2, k)
+
+        gates=[(gate.matrix.todense().data,
+                [sources[wire] for wire in gate.in_wires],
+                [sources[wire] for wire in gate.out_wires]) for gate in self.gates]
+        # Outputs wired straight to an input must carry the input's value
+        fixed=[(i, in_v[self.input.index(self.output[i])]) for i in range(len(self)) if self.output[i] in self.input]
+        spec=(len(self), len(int_wires), gates, fixed)
         
-        index=0
-        for out in product(range(2),repeat=len(self)):
-            Sum=0
-            check=False
-            
-            for i in range(len(self)):
-                for wire in self.input:
-                    if self.output[i] == wire:
-                        if wire.value != out[i]:
-                            check=True
-                if check:
-                    break
-                (self.output[i]).value=out[i]
-                
-            if check:
-                index+=1
-                continue
-            
-            for assign in product(range(2),repeat=len(int_wires)):
-                assign=list(assign)
-                for i in range(len(int_wires)):
-                    (int_wires[i]).value=assign[i]
-                
-                prod=1
-                for gate in self.gates:
-                    endqbits=[str(wire.value) for wire in gate.out_wires]
-                    startqbits=[str(wire.value) for wire in gate.in_wires]
-                    i=int('0b'+(''.join(startqbits)),2)
-                    j=int('0b'+(''.join(endqbits)),2)
-                    if gate.matrix[i][j]==0:
-                        prod=0
-                        break
-                    prod=prod*(gate.matrix[i][j])
-                    
-                Sum+=prod
-            
-            weights[index]=((abs(Sum))**2)
-            index+=1
+        # Blocks of consecutive outputs, each small enough to be summed over all internal assignments
+        size=2**len(self)
+        block=max(1, FEYNMAN_BLOCK//min(2**len(int_wires), FEYNMAN_BLOCK))
+        starts=list(range(0, size, block))
+        stops=[min(start+block, size) for start in starts]
+        
+        if workers is None:
+            workers=cpu_count() if size*(2**len(int_wires))*len(gates)>=FEYNMAN_PARALLEL else 1
+        if workers>1 and len(starts)>1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                blocks=list(executor.map(_feynman_block, [spec]*len(starts), starts, stops))
+        else:
+            blocks=[_feynman_block(spec, start, stop) for start, stop in zip(starts, stops)]
             
-        return weights
+        return np.concatenate(blocks)
     
     #method2 is the matrix multiplication approach
     def run_method2(self, in_v):
-        self.sort()
+        plan=self.compile()
         
-        if len(in_v) != len(self):
-            raise RuntimeError("Input length does not match the size of the circuit.")
-        for i in in_v:
-            if i==0 or i==1:
-                pass
-            else:
-                raise RuntimeError("Invalid input - values must be 0 or 1.")
+        self.check_input(in_v)
             
         states=[]
         weights=[]
@@ -300,70 +678,367 @@ class Circuit(object):
         else:
             states=states[0]
                 
-        for g_i in range(len(self.gates)):
-            gate=self.gates[g_i]
-            startqbits=[self.startqbit(g_i,i) for i in range(len(gate))]
-            permutation=[i for i in range(len(self))]
-            for i in range(len(startqbits)):
-                x=permutation[i]
-                y=startqbits[i]
-                if x != y :
-                    j=permutation.index(y)
-                    permutation[i]=y
-                    permutation[j]=x
-            
-            P1=Matrix.Permutation(permutation)
-            if not P1.isUnitary():
-                print("permutation matrix seems to be wrong")
-            P2=P1.getConjugate()
-            
-            if len(self)==len(gate):
-                M=gate.get_matrix()
-            else:
-                M=tensor([gate.get_matrix(),Matrix.Id(2**(len(self)-len(gate)))])
-            
-            states=P2*states
-            states=M*states
-            states=P1*states
-            
-        startqbits=self.startqbits()
-        P1=Matrix.Permutation(startqbits)
-        P1.transpose()
-        states=P1*states
+        states=self._evolve_matrix(plan, states)
 
         for x in range(len(states)):
             weights.append((abs(states[x][0]))**2)
             
         return weights
     
-    #this is the method that should be used for running the circuit. If the prefered method of
-    #computation is not specified the faster one is automatically chosen
-    def run(self,in_v,method=None):
+    #method3 is the statevector approach. The state is kept as a 2x2x...x2 tensor with one axis per
+    #qbit and every gate's matrix is applied directly to the axes of the qbits it acts on
+    def run_method3(self, in_v):
+        plan=self.compile()
+        self.check_input(in_v)
+
+        n=len(self)
+        state=np.zeros(2**n, dtype=np.complex128)
+        state[int(''.join(map(str, in_v)), 2)]=1
+        state=self._evolve_tensor(plan, state.reshape((2,)*n)).reshape(-1)
+
+        return np.abs(state)**2
+    
+    #method4 is a Feynman path sum that only follows paths with a nonzero amplitude. The sorted gates
+    #are walked depth first and every gate branches only into the nonzero entries of its matrix column
+    #for the values on its input wires, so the cost scales with the number of nonzero paths
+    def run_method4(self, in_v):
+        self.check_input(in_v)
+
+        weights=np.zeros(2**len(self))
+        for out, amplitude in self._path_sum(in_v).items():
+            weights[out]=abs(amplitude)**2
+            
+        return weights
+    
+    #method5 contracts the circuit as a tensor network (see main/tensornet.py). The memory needed
+    #depends on how the gates are wired rather than on the number of qbits, apart from the 2^n
+    #output weights themselves - use marginal or amplitude(method=5) for wide circuits
+    def run_method5(self, in_v):
+        self.check_input(in_v)
+        return tensornet.probabilities(self, in_v)
+    
+    #returns the probabilities of the values of the given outputs (the first one is the most
+    #significant bit) for the input in_v, summed over the other outputs. Computed by contracting a
+    #tensor network, or exactly with a stabilizer tableau for Clifford circuits, so it works for
+    #circuits too wide for the full output vector
+    def marginal(self, in_v, outputs):
+        self.check_input(in_v)
+        for i in outputs:
+            if not 0 <= i < len(self):
+                raise RuntimeError("Invalid output {0} - the circuit has {1} outputs.".format(i, len(self)))
+        if self.is_clifford():
+            return stabilizer.simulate(self, in_v).marginal(outputs)
+        return tensornet.marginal(self, in_v, outputs)
+    
+    #method6 keeps the state as a matrix product state (see main/mps.py), which stays small as long as
+    #the circuit creates little entanglement. The bond dimension is limited to mps.MAX_BOND, beyond that
+    #the result is approximate - use simulate_mps to choose the limits and to see the fidelity
+    def run_method6(self, in_v):
+        self.check_input(in_v)
+        state=mps.simulate(self, in_v).state()
+        state=state.transpose(self.compile().output).reshape(-1)
+        return np.abs(state)**2
+    
+    #draws shots samples from the matrix product state, qbit by qbit, without forming the 2^n state
+    def sample_method6(self, in_v, shots):
+        self.check_input(in_v)
+        state=mps.simulate(self, in_v)
+        bits=state.sample(shots, np.random.default_rng(getrandbits(64)))
+        return self._outcomes(bits[:, list(self.compile().output)])
+    
+    #returns the matrix product state of the circuit for the input in_v, keeping at most max_bond
+    #singular values per bond and dropping singular values of total weight up to max_error at a time.
+    #Its fidelity attribute estimates the overlap with the exact state
+    def simulate_mps(self, in_v, max_bond=mps.MAX_BOND, max_error=mps.MAX_ERROR):
+        self.check_input(in_v)
+        return mps.simulate(self, in_v, max_bond, max_error)
+
+    #tells whether every gate of the circuit is a Clifford gate (X, Y, Z, H, CNot, S, SqrtNot and their
+    #tensor products), so that the circuit can be simulated with a stabilizer tableau (method 7)
+    def is_clifford(self):
+        return stabilizer.program(self) is not None
+
+    #method7 simulates Clifford circuits with a stabilizer tableau (see main/stabilizer.py) in time and
+    #memory polynomial in the number of qbits, apart from the 2^n output weights themselves
+    def run_method7(self, in_v):
+        return self.simulate_stabilizer(in_v).marginal(range(len(self)))
+
+    #draws shots samples from the output distribution of a Clifford circuit
+    def sample_method7(self, in_v, shots):
+        bits=self.simulate_stabilizer(in_v).sample(shots, np.random.default_rng(getrandbits(64)))
+        return self._outcomes(bits)
+
+    #returns the exact output distribution of a Clifford circuit for the input in_v. Its probability
+    #and marginal methods answer queries about any of the outputs without simulating again
+    def simulate_stabilizer(self, in_v):
+        self.check_input(in_v)
+        return stabilizer.simulate(self, in_v)
+
+    #tells whether every gate of the circuit maps basis states to basis states (X, CNot, T, permutation
+    #oracles ...), so that every input leads to a single output that evaluate computes directly
+    def is_classical(self):
+        return classical.program(self) is not None
+
+    #returns the output vector of a classical circuit for the input in_v. The gates are applied as bit
+    #operations on an integer, so the time is linear in the number of gates for any width
+    def evaluate(self, in_v):
+        self.check_input(in_v)
+        return classical.evaluate(self, in_v)
+
+    #returns the outputs of a classical circuit for all 2^n inputs, computed at once in bit-sliced form:
+    #entry i is the output (as an integer) for the input with integer value i
+    def truth_table(self):
+        return classical.truth_table(self)
+
+    #compares a classical circuit with the function reference (input vector -> output vector) on the
+    #given inputs, all of them by default, and returns the inputs (integers) where they differ. A
+    #vectorized reference gets one numpy array of bits per input and returns one per output
+    def verify(self, reference, inputs=None, vectorized=False):
+        return classical.mismatches(self, reference, inputs, vectorized)
+
+    #method8 evaluates classical circuits: the single output reached from in_v has probability 1
+    def run_method8(self, in_v):
+        weights=np.zeros(2**len(self))
+        weights[int(''.join(map(str, self.evaluate(in_v))), 2)]=1
+        return weights
+
+    #every sample of a classical circuit is the output of evaluate
+    def sample_method8(self, in_v, shots):
+        outcome=self._outcomes(np.array([self.evaluate(in_v)]))[0]
+        return np.full(shots, outcome, dtype=object if len(self)>62 else np.int64)
+
+    #method9 stores only the nonzero amplitudes (see main/sparsestate.py), so circuits that stay close
+    #to a few basis states (oracles, classical registers ...) cost time and memory proportional to the
+    #number of populated states. The state turns dense once too many amplitudes are nonzero
+    def run_method9(self, in_v):
+        return self.simulate_sparse(in_v).weights(self.compile().output)
+
+    #draws shots samples from the sparse state without forming the 2^n output weights
+    def sample_method9(self, in_v, shots):
+        state=self.simulate_sparse(in_v)
+        return state.sample(shots, np.random.default_rng(getrandbits(64)), self.compile().output)
+
+    #returns the sparse state of the circuit for the input in_v. Amplitudes of modulus below threshold
+    #are dropped and the state turns dense once more than a fraction density of them are nonzero
+    def simulate_sparse(self, in_v, threshold=sparsestate.THRESHOLD, density=sparsestate.DENSITY):
+        self.check_input(in_v)
+        return sparsestate.simulate(self, in_v, threshold, density)
+
+    #method10 represents the state and the gates as decision diagrams (see main/qmdd.py), in which equal
+    #parts of the state are stored once. Structured circuits such as Grover's algorithm keep diagrams of
+    #a size polynomial in the number of qbits
+    def run_method10(self, in_v):
+        state=self.simulate_qmdd(in_v).state()
+        state=state.transpose(self.compile().output).reshape(-1)
+        return np.abs(state)**2
+
+    #draws shots samples from the decision diagram, qbit by qbit, without forming the 2^n state
+    def sample_method10(self, in_v, shots):
+        bits=self.simulate_qmdd(in_v).sample(shots, np.random.default_rng(getrandbits(64)))
+        return self._outcomes(bits[:, list(self.compile().output)])
+
+    #returns the decision diagram of the state of the circuit for the input in_v. The gate diagrams are
+    #kept with the circuit's compiled plan, so later runs reuse them
+    def simulate_qmdd(self, in_v):
+        self.check_input(in_v)
+        return qmdd.simulate(self, in_v)
+
+    # Turns rows of output bits (the first output is the most significant bit) into integers. Outcomes
+    # of more than 62 bits are python integers in an object array.
+    def _outcomes(self, bits):
+        n=bits.shape[1]
+        if n<=62:
+            return bits.astype(np.int64) @ (1 << np.arange(n-1, -1, -1, dtype=np.int64))
+        # the rows are packed into whole bytes, padded with zeros in front
+        packed=np.packbits(np.pad(bits.astype(np.uint8), ((0, 0), ((-n) % 8, 0))), axis=1)
+        k=packed.shape[1]
+        data=packed.tobytes()
+        return np.array([int.from_bytes(data[i*k:(i+1)*k], 'big') for i in range(len(packed))], dtype=object)
+    
+    # Sums the amplitudes of all nonzero paths through the circuit for the input in_v and returns them
+    # as a dictionary of output values (the first output is the most significant bit) to amplitudes.
+    # If out_v is given, only the paths ending in it are followed.
+    def _path_sum(self, in_v, out_v=None):
+        self.compile()
+        gates=self.gates
+        n=len(self)
+
+        slots={wire: i for i, wire in enumerate(self.wires)}
+        in_slots=[[slots[w] for w in gate.in_wires] for gate in gates]
+        out_slots=[[slots[w] for w in gate.out_wires] for gate in gates]
+        output_slots=[slots[w] for w in self.output]
+        values=[0]*len(slots)
+        for i in range(n):
+            values[slots[self.input[i]]]=in_v[i]
+
+        # Gate output ports that lead to an output with a required value
+        required=[[] for gate in gates]
+        if out_v is not None:
+            required_slots={slots[self.output[i]]: out_v[i] for i in range(n)}
+            for i in range(n):
+                if self.output[i] in self.input and in_v[self.input.index(self.output[i])]!=out_v[i]:
+                    return {}
+            for g in range(len(gates)):
+                required[g]=[(p, required_slots[slot]) for p, slot in enumerate(out_slots[g]) if slot in required_slots]
+
+        # The nonzero entries of every gate column that is reached, computed once per column
+        columns=[{} for gate in gates]
+        def column(g, pattern):
+            if pattern not in columns[g]:
+                unit=np.zeros((2**len(gates[g]), 1))
+                unit[pattern]=1
+                entries=gates[g].matrix.dot(unit)[:, 0]
+                rows=np.flatnonzero(entries)
+                columns[g][pattern]=(rows.tolist(), entries[rows].tolist())
+            return columns[g][pattern]
+
+        # Iterative depth-first walk. branches[g] holds the column of gate g that is being expanded
+        # and the position of the next entry, amplitudes[g] the amplitude of the path before gate g
+        result={}
+        branches=[None]*len(gates)
+        amplitudes=[1]*(len(gates)+1)
+        g=0
+        while g>=0:
+            if g==len(gates):
+                out=0
+                for slot in output_slots:
+                    out=(out << 1) | values[slot]
+                result[out]=result.get(out, 0)+amplitudes[g]
+                g-=1
+                continue
+
+            if branches[g] is None:
+                pattern=0
+                for slot in in_slots[g]:
+                    pattern=(pattern << 1) | values[slot]
+                rows, entries=column(g, pattern)
+                if required[g]:
+                    k=len(out_slots[g])
+                    kept=[i for i, row in enumerate(rows) if all(((row >> (k-1-p)) & 1)==bit for p, bit in required[g])]
+                    rows, entries=[rows[i] for i in kept], [entries[i] for i in kept]
+                branches[g]=[(rows, entries), 0]
+            (rows, entries), position=branches[g]
+            if position==len(rows):
+                branches[g]=None
+                g-=1
+                continue
+
+            branches[g][1]+=1
+            row=rows[position]
+            k=len(out_slots[g])
+            for i, slot in enumerate(out_slots[g]):
+                values[slot]=(row >> (k-1-i)) & 1
+            amplitudes[g+1]=amplitudes[g]*entries[position]
+            g+=1
+
+        return result
+    
+    #returns the amplitude of the output out_v (a list of bits or its integer value) for the input in_v.
+    #With method=4 only the paths through the internal wires that end in out_v are summed, so the memory
+    #needed stays polynomial in the size of the circuit. method=5 contracts a tensor network instead,
+    #which is faster when there are many paths and the circuit is shallow. If the method is not
+    #specified, the cost model picks the faster of the two
+    def amplitude(self, in_v, out_v, method=None):
+        return self.amplitudes(in_v, [out_v], method)[0]
+    
+    #returns the amplitudes of all outputs in the list out_vs for the input in_v
+    def amplitudes(self, in_v, out_vs, method=None):
+        self.check_input(in_v)
         if not method:
-            int_wires=self.get_internal_wires()
-            n1=len(self.gates)*(2**(len(self)+len(int_wires)))
-            n2=(3*len(self.gates))*(2**(2*len(self)))
-            if n1<=n2:
-                print("Running method 1...")
-                method=1
-            else:
-                print("Running method 2...")
-                method=2
+            method=cost.get_model().choose(self, methods=(4, 5))
+        elif method not in (4, 5):
+            raise RuntimeError("Amplitudes can be computed with method 4 or 5.")
+        
+        decoded=[]
+        for out_v in out_vs:
+            if isinstance(out_v, int):
+                out_v=Counts.decode(out_v, len(self))
+            self.check_input(out_v)
+            decoded.append(out_v)
         
-        if method==1:
-            weights=self.run_method1(in_v)
-        elif method==2:
-            weights=self.run_method2(in_v)
+        if method==5:
+            return tensornet.amplitudes(self, in_v, decoded)
+        return [complex(self._path_sum(in_v, out_v).get(int(''.join(map(str, out_v)), 2), 0)) for out_v in decoded]
+    
+    #runs the circuit for many input vectors at once. The inputs are stacked as the columns of one
+    #state matrix that is pushed through the gates a single time, with the matrix multiplication
+    #(method=2) or the statevector (method=3) approach. Returns one probability vector per input.
+    def run_batch(self, inputs, method=3):
+        plan=self.compile()
+        for in_v in inputs:
+            self.check_input(in_v)
+
+        n=len(self)
+        states=np.zeros((2**n, len(inputs)), dtype=np.complex128)
+        for j, in_v in enumerate(inputs):
+            states[int(''.join(map(str, in_v)), 2), j]=1
+
+        if method==2:
+            states=self._evolve_matrix(plan, Matrix.from_array(states)).data
+        elif method==3:
+            states=self._evolve_tensor(plan, states.reshape((2,)*n+(len(inputs),))).reshape(2**n, -1)
         else:
-            raise RuntimeError("Please choose one of the avalible methods: 1 or 2")
-            
-        states=[]
-        for out in product(range(2),repeat=len(self)):
-            states.append(list(out))
-            
-        results=choices(states, weights)[0]
+            raise RuntimeError("Please choose one of the avalible batch methods: 2 or 3")
+
+        return list((np.abs(states)**2).T)
+    
+    #returns the probabilities of all 2^n outputs for the input in_v. If the prefered method of
+    #computation is not specified, the cost model picks the fastest one that fits into its memory budget
+    def probabilities(self,in_v,method=None):
+        model=cost.get_model()
+        if not method:
+            method=model.choose(self)
+        else:
+            model.check(self,method)
             
-        return results
+        return getattr(self,'run_method%d' % method)(in_v)
+    
+    #simulates the circuit once and draws shots samples from the output distribution. The samples are
+    #returned in the order they were drawn, as integers (the first output is the most significant bit).
+    #Methods with a sampler of their own (sample_methodN) never form the 2^n output weights
+    def sample(self,in_v,shots,method=None):
+        model=cost.get_model()
+        if not method:
+            method=model.choose(self,sampling=True,shots=shots)
+        else:
+            model.check(self,method,sampling=True)
+        
+        sampler=getattr(self,'sample_method%d' % method,None)
+        if sampler is not None:
+            return sampler(in_v,shots)
+        weights=getattr(self,'run_method%d' % method)(in_v)
+        return sample_weights(weights,shots,np.random.default_rng(getrandbits(64)))
+    
+    #this is the method that should be used for running the circuit. Without shots it returns one
+    #measured output vector, otherwise it simulates once and returns the counts of shots measurements
+    def run(self,in_v,method=None,shots=None):
+        if shots is None:
+            return Counts.decode(int(self.sample(in_v,1,method)[0]),len(self))
+        return Counts(self.sample(in_v,shots,method),len(self))
+    
+    #checks that in_v is a valid input vector for the circuit
+    def check_input(self, in_v):
+        if len(in_v) != len(self):
+            raise RuntimeError("Input length does not match the size of the circuit.")
+        for i in in_v:
+            if i==0 or i==1:
+                pass
+            else:
+                raise RuntimeError("Invalid input - values must be 0 or 1.")
+    
+    #returns the qubit permutation that brings the qbits with the given start indices to the top
+    #of the register, in the given order, so that a gate can act on them there
+    def gate_permutation(self, startqbits):
+        permutation=[i for i in range(len(self))]
+        for i in range(len(startqbits)):
+            x=permutation[i]
+            y=startqbits[i]
+            if x != y :
+                j=permutation.index(y)
+                permutation[i]=y
+                permutation[j]=x
+        
+        return QubitPermutation(permutation)
     
     #these are helper methods that give the input/output index of a given qbit
     def endqbit(self, gate_index, outwire_index):
@@ -402,9 +1077,10 @@ class Circuit(object):
             
         return startqbits
     
-    #returns a random quantum circuit of a specified size and number of gates. useful for testing
+    #returns a random quantum circuit of a specified size and number of gates, made of the given gate
+    #types. useful for testing
     @staticmethod
-    def random_circuit(size=0, gates=0):
+    def random_circuit(size=0, gates=0, types=None):
         if size==0:
             size=randint(3,6)
         if gates==0:
@@ -413,16 +1089,20 @@ class Circuit(object):
             n_gates=gates
             
         c=Circuit(size)
+        gates=[]
+        wires=[]
         av_comp=[c]
         av_in=[[i for i in range(size)]]
         for i in range(n_gates):
-            gate=c.add(choice([X(1,"Gate "+str(i)),Y(1,"Gate "+str(i)),Z(1,"Gate "+str(i)),H(1,"Gate "+str(i)),CNot("Gate "+str(i)),T("Gate "+str(i))]))
+            t=choice(types or [X,Y,Z,H,CNot,T])
+            gate=t(1,"Gate "+str(i)) if t.SIZE==1 else t("Gate "+str(i))
+            gates.append(gate)
             for in_wire in range(len(gate)):
                 j=randint(0,len(av_comp)-1)
                 component=av_comp[j]
                 k=randint(0,len(av_in[j])-1)
                 inputs=av_in[j][k]
-                c.add_wire(component, inputs ,gate ,in_wire)
+                wires.append((component, inputs ,gate ,in_wire))
                 del av_in[j][k]
                 if av_in[j]==[]:
                     del av_in[j]
@@ -436,12 +1116,13 @@ class Circuit(object):
             component=av_comp[j]
             k=randint(0,len(av_in[j])-1)
             inputs=av_in[j][k]
-            c.add_wire(component, inputs ,c ,i)
+            wires.append((component, inputs ,c ,i))
             del av_in[j][k]
             if av_in[j]==[]:
                 del av_in[j]
                 del av_comp[j]
         
+        c.extend(gates, wires)
         return c
 
 
@@ -450,7 +1131,7 @@ class Gate(object):
 
     def __init__(self, mtrx, name, bypass_error_check=False):
         if not bypass_error_check:
-            if len(mtrx)!=len(mtrx.rows[0]):
+            if len(mtrx)!=mtrx.shape[1]:
                 raise RuntimeError("Gates should be represented by square matrices.")
             if not mtrx.isUnitary():
                 raise RuntimeError("Gates should be represented by unitary matrices.")
@@ -464,12 +1145,23 @@ class Gate(object):
         self.out_wires = [None] * size
         self.name = name
 
-        self.marked=False
-        self.tempmarked=False
-
         self.parent = None
-        self.uuid = None
+        self._uuid = None
         self.id = None
+        self.key = None
+
+    # The uuid is always saved, so gates can be matched with their copies. Gates pickled before it was
+    # generated lazily store it directly.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_uuid'] = self.uuid
+        return state
+
+    def __setstate__(self, state):
+        if 'uuid' in state:
+            state['_uuid'] = state.pop('uuid')
+        state.setdefault('key', None)
+        self.__dict__.update(state)
 
     def __len__(self):
         return len(self.in_wires)
@@ -493,53 +1185,71 @@ class Gate(object):
     def __hash__(self):
         return hash(self.uuid)
 
+    # Identifies the gate, also in copies of the circuit. It is generated when it is first needed, gates
+    # that are not part of a circuit have none.
+    @property
+    def uuid(self):
+        if self._uuid is None and self.parent is not None:
+            self._uuid = uuid4()
+        return self._uuid
+
     # Sets the gate's parent (the circuit it belongs to) and its ID numbers
     def set_parent(self, parent):
         self.parent = parent
         self.id = parent.cls_ids[self.name]
-        self.uuid = uuid4()
-        while any(g.uuid == self.uuid for g in parent if g is not self):
-            self.uuid = uuid4()
+        self._uuid = None
         
     def get_matrix(self):
-        size=2**(len(self))
-        result = Matrix([[0]*size for x in range(size)])
-        for i in range(size):
-            for j in range(size):
-                result[i][j] = self.matrix[i][j]
+        return self.matrix.copy()
 
-        return result
+# The standard gates on at most SHARED_SIZE qbits share one matrix per type and size, so building a large
+# circuit does not build the same small matrices over and over. The arrays of a shared matrix are made
+# read-only so that an in-place numpy operation on one gate cannot change the others, and every gate
+# gets its own view of them (see Matrix.view), so that transposing one gate's matrix does not transpose
+# the others.
+SHARED_SIZE = 3
+
+@lru_cache(maxsize=None)
+def _shared_matrix(build, *args):
+    M = build(*args)
+    arrays = [M.data] if isinstance(M, Matrix) else [M.indptr, M.indices, M.values]
+    for a in arrays:
+        a.flags.writeable = False
+    return M
+
+def _gate_matrix(build, size):
+    return _shared_matrix(build, size).view() if size <= SHARED_SIZE else build(size)
 
 class X(Gate):
     def __init__(self,size=1, name="X"):
-        super().__init__(Matrix.X(size), name, True)
+        super().__init__(_gate_matrix(Matrix.X, size), name, True)
 
 class Y(Gate):
     def __init__(self,size=1, name="Y"):
-        super().__init__(Matrix.Y(size), name, True)
+        super().__init__(_gate_matrix(Matrix.Y, size), name, True)
 
 class Z(Gate):
     def __init__(self,size=1, name="Z"):
-        super().__init__(Matrix.Z(size), name, True)
+        super().__init__(_gate_matrix(Matrix.Z, size), name, True)
 
 class H(Gate):
     def __init__(self,size=1, name="H"):
-        super().__init__(Matrix.H(size), name, True)
+        super().__init__(_gate_matrix(Matrix.H, size), name, True)
         
 class SqrtNot(Gate):
     def __init__(self,size=1, name="SqrtNot"):
-        super().__init__(Matrix.SqrtNot(size), name, True)
+        super().__init__(_gate_matrix(Matrix.SqrtNot, size), name, True)
         
 class QFT(Gate):
     def __init__(self,size=1, name="QFT"):
-        super().__init__(Matrix.QFT(size), name, True)
+        super().__init__(_gate_matrix(Matrix.QFT, size), name, True)
 
 class CNot(Gate):
     SIZE = 2
     def __init__(self, name="CNot"):
-        super().__init__(Matrix.Cnot(), name, True)
+        super().__init__(_shared_matrix(SparseMatrix.Cnot).view(), name, True)
 
 class T(Gate):
     SIZE = 3
     def __init__(self, name="T"):
-        super().__init__(Matrix.T(), name, True)
+        super().__init__(_shared_matrix(SparseMatrix.T).view(), name, True)
@@ -0,0 +1,234 @@
+from main.matrix import SparseMatrix, QubitPermutation, column_nonzeros
+import numpy as np
+
+# Evaluation of classical reversible circuits. A gate whose matrix has exactly one nonzero entry of
+# modulus 1 in every column (X, CNot, T, Z, oracles such as Shor's U ...) maps every basis state to a
+# single basis state, so a circuit made only of such gates maps the input to one output with
+# probability 1. That output is computed with bit operations on an integer that holds the value of
+# lane L in bit L, one gate after the other, in time linear in the number of gates.
+#
+# Every gate becomes one operation (kind, a, b) on that integer:
+#   FLIP:        s ^= a                              (X on the lanes in mask a)
+#   CONTROLLED:  s ^= b if s & a == a                (CNot, T and other multi-controlled X gates)
+#   TABLE:       the bits of the lanes a (port 0 first) are replaced as given by the table b
+
+FLIP = 0
+CONTROLLED = 1
+TABLE = 2
+
+
+# Returns the basis permutation of the matrix as an array table (table[column] is the row of the
+# column's single nonzero entry), or None if the matrix does not map basis states to basis states
+def permutation_table(M):
+    if not (column_nonzeros(M) == 1).all():
+        return None
+    if isinstance(M, QubitPermutation):
+        table = np.empty(len(M), dtype=np.int64)
+        table[M.index] = np.arange(len(M))
+        return table
+    if isinstance(M, SparseMatrix):
+        rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+        columns, values = M.indices, M.values
+    else:
+        data = M.todense().data
+        columns = np.arange(data.shape[1])
+        rows = np.argmax(data != 0, axis=0)
+        values = data[rows, columns]
+    if not np.allclose(np.abs(values), 1):
+        return None
+    table = np.empty(M.shape[1], dtype=np.int64)
+    table[columns] = rows
+    if len(np.unique(table)) != len(table):
+        return None
+    return table
+
+
+# Returns the operation of a gate on k qbits with the given basis permutation, in terms of the gate's
+# ports (port 0 is the most significant bit of the table index), or None for the identity
+def _operation(table, k):
+    indices = np.arange(len(table))
+    if (table == indices).all():
+        return None
+    flip = int(table[0])
+    if (table == indices ^ flip).all():
+        return (FLIP, [p for p in range(k) if flip >> (k - 1 - p) & 1], None)
+    for target in range(k):
+        t = 1 << (k - 1 - target)
+        controls = (len(table) - 1) ^ t
+        if (table == np.where(indices & controls == controls, indices ^ t, indices)).all():
+            return (CONTROLLED, [p for p in range(k) if p != target], [target])
+    return (TABLE, list(range(k)), table)
+
+
+# Returns the operation of a gate matrix, or False if the matrix is not classical
+def operation(M):
+    table = permutation_table(M)
+    return False if table is None else _operation(table, len(M).bit_length() - 1)
+
+
+# Returns the list of operations (kind, a, b) of the circuit on the lanes, or None if some gate does not
+# map basis states to basis states. The list is kept with the compiled plan.
+def program(circuit):
+    plan = circuit.compile()
+    if 'classical' not in plan.programs:
+        plan.programs['classical'] = _program(plan)
+    return plan.programs['classical']
+
+
+def _program(plan):
+    # The standard gates share their matrices, so each is looked at once. The plan keeps the matrices
+    # alive, so their ids stay unique.
+    operations = {}
+    ops = []
+    for instruction in plan.instructions:
+        M = instruction.matrix
+        if id(M) not in operations:
+            operations[id(M)] = operation(M)
+        op = operations[id(M)]
+        if op is False:
+            return None
+        if op is None:
+            continue
+        kind, a, b = op
+        lanes = instruction.lanes
+        if kind == FLIP:
+            ops.append((FLIP, sum(1 << lanes[p] for p in a), 0))
+        elif kind == CONTROLLED:
+            ops.append((CONTROLLED, sum(1 << lanes[p] for p in a), 1 << lanes[b[0]]))
+        else:
+            ops.append((TABLE, tuple(lanes[p] for p in a), b.tolist()))
+
+    return ops
+
+
+# Runs the operations on the integer state s and returns the final state
+def execute(ops, s):
+    for kind, a, b in ops:
+        if kind == FLIP:
+            s ^= a
+        elif kind == CONTROLLED:
+            if s & a == a:
+                s ^= b
+        else:
+            index = 0
+            for lane in a:
+                index = index << 1 | (s >> lane & 1)
+            value = b[index]
+            for i, lane in enumerate(reversed(a)):
+                s = s & ~(1 << lane) | (value >> i & 1) << lane
+    return s
+
+
+# Returns the output bits of the classical circuit for the input in_v
+def evaluate(circuit, in_v):
+    ops = program(circuit)
+    if ops is None:
+        raise RuntimeError("The circuit contains gates that do not map basis states to basis states.")
+    s = execute(ops, sum(bit << lane for lane, bit in enumerate(in_v)))
+    return [s >> lane & 1 for lane in circuit.compile().output]
+
+
+# Bit-sliced evaluation of all 2^n inputs at once. Every lane holds one bit per input, packed into
+# uint64 words: bit j of word w is the lane's value for the input with integer value 64w+j (the first
+# input is the most significant bit). A gate is then a few AND/XOR operations on whole words.
+
+# Largest width truth_table accepts, the lanes take n 2^n / 8 bytes
+MAX_WIDTH = 30
+
+ONES = np.uint64(2**64 - 1)
+
+# Word patterns of the inputs that change within a word: bit s of j for j = 0, ..., 63
+_PATTERNS = [sum(1 << j for j in range(64) if j >> s & 1) for s in range(6)]
+
+
+def _lanes(mask):
+    return [lane for lane in range(mask.bit_length()) if mask >> lane & 1]
+
+
+# Returns the bit-sliced values of the lanes at the end of the classical circuit, one array per lane
+def sliced(circuit):
+    ops = program(circuit)
+    if ops is None:
+        raise RuntimeError("The circuit contains gates that do not map basis states to basis states.")
+    n = len(circuit)
+    if n > MAX_WIDTH:
+        raise RuntimeError("Cannot build the truth table of {0} qbits, the limit is {1}.".format(n, MAX_WIDTH))
+
+    words = max(1, 2**n // 64)
+    w = np.arange(words, dtype=np.uint64)
+    values = []
+    for lane in range(n):
+        s = n - 1 - lane
+        if s < 6:
+            values.append(np.full(words, _PATTERNS[s], dtype=np.uint64))
+        else:
+            values.append(np.uint64(0) - ((w >> np.uint64(s - 6)) & np.uint64(1)))
+
+    for kind, a, b in ops:
+        if kind == FLIP:
+            for lane in _lanes(a):
+                values[lane] ^= ONES
+        elif kind == CONTROLLED:
+            controls = _lanes(a)
+            condition = values[controls[0]].copy()
+            for lane in controls[1:]:
+                condition &= values[lane]
+            values[b.bit_length() - 1] ^= condition
+        else:
+            # Every output port is the OR of the minterms of the inputs the table sends to a 1 there
+            k = len(a)
+            result = [np.zeros(words, dtype=np.uint64) for _ in a]
+            for index, value in enumerate(b):
+                if not value:
+                    continue
+                minterm = np.full(words, ONES)
+                for p, lane in enumerate(a):
+                    minterm &= values[lane] if index >> (k - 1 - p) & 1 else ~values[lane]
+                for p in range(k):
+                    if value >> (k - 1 - p) & 1:
+                        result[p] |= minterm
+            for lane, bits in zip(a, result):
+                values[lane] = bits
+    return values
+
+
+def _bits(words, n):
+    return np.unpackbits(words.astype('<u8').view(np.uint8), bitorder='little')[:2**n]
+
+
+# Returns the outputs of the classical circuit for all inputs: entry i is the output (as an integer, the
+# first output is the most significant bit) for the input with integer value i
+def truth_table(circuit):
+    values = sliced(circuit)
+    n = len(circuit)
+    table = np.zeros(2**n, dtype=np.int64)
+    for lane in circuit.compile().output:
+        table <<= 1
+        table |= _bits(values[lane], n)
+    return table
+
+
+# Returns the inputs (integers) for which the classical circuit's outputs differ from the function
+# reference. reference maps an input vector to an output vector. With vectorized, it is called once
+# with one array per input that holds the bit of every input checked, and returns one such array per
+# output. inputs lists the inputs (vectors or integers) to check, by default all of them.
+def mismatches(circuit, reference, inputs=None, vectorized=False):
+    n = len(circuit)
+    if inputs is None:
+        inputs = np.arange(2**n, dtype=np.int64)
+    else:
+        inputs = np.array([i if isinstance(i, (int, np.integer)) else int(''.join(map(str, i)), 2)
+                           for i in inputs], dtype=np.int64)
+    values = sliced(circuit)
+    outputs = [_bits(values[lane], n)[inputs] for lane in circuit.compile().output]
+
+    if vectorized:
+        expected = reference([(inputs >> (n - 1 - i)) & 1 for i in range(n)])
+        wrong = np.zeros(len(inputs), dtype=bool)
+        for got, want in zip(outputs, expected):
+            wrong |= got != (np.asarray(want) & 1)
+        return inputs[wrong].tolist()
+
+    got = np.array(outputs).T.tolist() if len(inputs) else []
+    return [int(i) for i, row in zip(inputs, got)
+            if list(reference([int(i) >> (n - 1 - j) & 1 for j in range(n)])) != row]
@@ -1,9 +1,12 @@
 from main.circuit import *
 from itertools import product
-from random import randint, choice
+from random import randint, choice, shuffle
+import time
+import numpy as np
 
 test1=True
 test2=True
+test3=True
 
 #test function for circuit (5) from the paper
 def test_function(in_v):
@@ -70,6 +73,15 @@ if test2:
         else:
             print("Method2 failed for input: "+str(in_v))
 
+#test for the truth table, which evaluates all inputs at once
+if test3:
+    inputs=[list(in_v)+[0,0,0,0] for in_v in product(range(2),repeat=2)]
+    failed=c.verify(test_function,inputs)
+    if not failed:
+        print("Check.")
+    else:
+        print("Truth table failed for inputs: "+str([Counts.decode(i,len(c)) for i in failed]))
+
 def random_test(iterations):
     for it in range(iterations):
         size=randint(3,6)
@@ -104,16 +116,510 @@ def random_test(iterations):
                 del av_in[j]
                 del av_comp[j]
                 
+        #every method is checked against the statevector (method 3)
+        methods=[1, 2, 4, 5, 6, 9, 10]
+        if c.is_clifford():
+            methods.append(7)
+        table=None
+        if c.is_classical():
+            methods.append(8)
+            table=c.truth_table()
         for in_v in product(range(2),repeat=len(c)): 
             in_v=list(in_v)
-            weights1=c.run_method1(in_v)
-            weights2=c.run_method2(in_v)
-            for k in range(len(weights1)):
-                if round(weights1[k], 14)!= round(weights2[k], 14):
-                    print("difference detected: "+str(weights1[k])+"; "+str(weights2[k]))
-                    print("input vector was: "+str(in_v))
-                    return c
+            weights3=c.run_method3(in_v)
+            if table is not None and weights3[table[int(''.join(map(str, in_v)), 2)]]<1-1e-12:
+                print("truth table maps input "+str(in_v)+" to "+str(table[int(''.join(map(str, in_v)), 2)]))
+                return c
+            for method in methods:
+                weights=getattr(c, 'run_method'+str(method))(in_v)
+                for k in range(len(weights3)):
+                    if abs(weights[k]-weights3[k])>1e-12:
+                        print("difference detected with method "+str(method)+": "+str(weights[k])+"; "+str(weights3[k]))
+                        print("input vector was: "+str(in_v))
+                        return c
             
     return "all tests passed"
 
-    
\ No newline at end of file
+    
+#returns True if the gates of the circuit c are wired into a cycle
+def has_cycle(c):
+    state={}
+    for start in c.gates:
+        if start in state:
+            continue
+        state[start]=1
+        stack=[(start, iter(start.out_wires))]
+        while stack:
+            g, wires=stack[-1]
+            w=next(wires, None)
+            if w is None:
+                state[g]=2
+                stack.pop()
+            elif w.is_internal():
+                if state.get(w.right)==1:
+                    return True
+                if w.right not in state:
+                    state[w.right]=1
+                    stack.append((w.right, iter(w.right.out_wires)))
+    return False
+
+#test for the topological order kept while a circuit is edited. Random circuits with cycles are built
+#gate by gate or all at once, then wires between gates are replaced by wires to the circuit's own ports.
+#contains_cycle has to find the cycles and, once there are none left, sort has to put every gate after
+#the gates wired into it.
+def order_test(iterations):
+    for it in range(iterations):
+        gates=[choice([X(1,"Gate "+str(i)),CNot("Gate "+str(i))]) for i in range(randint(3,9))]
+        outs=[(g,p) for g in gates for p in range(len(g))]
+        ins=[(g,p) for g in gates for p in range(len(g))]
+        shuffle(outs)
+        shuffle(ins)
+        pairs=[randint(0,4)>0 for i in outs]
+        size=len(outs)
+        #None stands for the circuit itself
+        wires=[(g,p,h,q) for (g,p),(h,q),pair in zip(outs,ins,pairs) if pair]
+        free_outs=[o for o,pair in zip(outs,pairs) if not pair]
+        free_ins=[i for i,pair in zip(ins,pairs) if not pair]
+        #unused circuit ports are wired straight through
+        spare=list(range(len(free_ins),size))
+        wires+=[(None,i,h,q) for i,(h,q) in enumerate(free_ins)]
+        wires+=[(g,p,None,i) for i,(g,p) in enumerate(free_outs)]
+        wires+=[(None,i,None,i) for i in spare]
+        shuffle(gates)
+        shuffle(wires)
+
+        c=Circuit(size)
+        wires=[(c if a is None else a,p,c if b is None else b,q) for a,p,b,q in wires]
+        try:
+            c.extend(gates,wires)
+        except RuntimeError:
+            c=Circuit(size)
+            wires=[(c if a is None or isinstance(a,Circuit) else a,p,c if b is None or isinstance(b,Circuit) else b,q) for a,p,b,q in wires]
+            for g in gates:
+                c.add(g)
+            for w in wires:
+                c.add_wire(*w)
+
+        for i in range(4):
+            cycle=has_cycle(c)
+            if c.contains_cycle()!=cycle:
+                print("contains_cycle returned "+str(not cycle)+" for:")
+                return c
+            if not cycle:
+                c.sort()
+                position={g: j for j, g in enumerate(c.gates)}
+                for w in c.get_internal_wires():
+                    if position[w.left]>=position[w.right]:
+                        print("sort put "+str(w.right)+" before "+str(w.left)+" in:")
+                        return c
+            internal=c.get_internal_wires()
+            if not internal:
+                break
+            w=choice(internal)
+            j=spare.pop()
+            c.remove_wire(c.input[j])
+            c.remove_wire(w)
+            c.add_wire(c,j,w.right,w.rind)
+            c.add_wire(w.left,w.lind,c,j)
+
+    return "all tests passed"
+
+
+#builds a chain of size X gates whose wires are added against the order the gates were added in, which
+#has to take linear time, then closes it into a cycle
+def back_chain_test(size):
+    c=Circuit(1)
+    gates=[c.add_gate(X) for i in range(size)]
+    start=time.time()
+    for i in range(size-1):
+        c.add_wire(gates[i+1],0,gates[i],0)
+    c.add_wire(c,0,gates[-1],0)
+    c.add_wire(gates[0],0,c,0)
+    c.sort()
+    if time.time()-start>size*1e-4:
+        print("adding "+str(size)+" wires took "+str(time.time()-start)+" seconds")
+        return c
+    if c.gates!=gates[::-1] or c.run([0])!=[size%2]:
+        print("the chain is not in order:")
+        return c
+
+    c.remove_wire(c.input[0])
+    c.remove_wire(c.output[0])
+    c.add_wire(gates[0],0,gates[-1],0)
+    if not c.contains_cycle():
+        print("the cycle was not found in:")
+        return c
+    return "all tests passed"
+
+
+#checks the truncation of the matrix product state (method 6): the bonds stay within max_bond and the
+#overlap with the exact state is at least the square of the fidelity it reports. With a single
+#truncation the fidelity is exact: a GHZ state cut down to one singular value per bond keeps half of
+#it, and a weakly entangled state loses the weight of the singular value that max_error allows to drop
+def mps_test(iterations):
+    for it in range(iterations):
+        size=randint(3,8)
+        c=Circuit.random_circuit(size,randint(size,5*size))
+        in_v=[randint(0,1) for i in range(size)]
+        exact=c.simulate_mps(in_v,2**size).state().reshape(-1)
+        state=c.simulate_mps(in_v,2)
+        overlap=abs(np.vdot(exact,state.state().reshape(-1)))**2
+        if max(t.shape[2] for t in state.tensors)>2 or not overlap>=state.fidelity**2-1e-12 or not 0<state.fidelity<=1:
+            print("fidelity "+str(state.fidelity)+" with overlap "+str(overlap)+" for input "+str(in_v)+" of:")
+            return c
+
+    c=Circuit(3)
+    h=c.add_gate(H)
+    g1=c.add_gate(CNot)
+    g2=c.add_gate(CNot)
+    c.add_wire(c,0,h,0)
+    c.add_wire(h,0,g1,0)
+    c.add_wire(c,1,g1,1)
+    c.add_wire(g1,1,g2,0)
+    c.add_wire(c,2,g2,1)
+    c.add_wires(g1,[0],c,[0])
+    c.add_wires(g2,[0,1],c,[1,2])
+    state=c.simulate_mps([0,0,0],1)
+    overlap=abs(state.state()[0,0,0]+state.state()[1,1,1])**2/2
+    if abs(state.fidelity-0.5)>1e-12 or abs(overlap-0.5)>1e-12:
+        print("GHZ state kept fidelity "+str(state.fidelity)+" and overlap "+str(overlap))
+        return c
+
+    angle=0.2
+    rotation=np.eye(4)
+    rotation[2:,2:]=[[np.cos(angle/2),-np.sin(angle/2)],[np.sin(angle/2),np.cos(angle/2)]]
+    c=Circuit(2)
+    h=c.add_gate(H)
+    g=c.add(Gate(Matrix.from_array(rotation),"CRy"))
+    c.add_wire(c,0,h,0)
+    c.add_wire(h,0,g,0)
+    c.add_wire(c,1,g,1)
+    c.add_wires(g,[0,1],c,[0,1])
+    kept=(1+np.cos(angle/2))/2
+    for max_error, fidelity in ((1e-3,1.),(1e-2,kept)):
+        state=c.simulate_mps([0,0],max_error=max_error)
+        if abs(state.fidelity-fidelity)>1e-12:
+            print("max_error "+str(max_error)+" gave fidelity "+str(state.fidelity)+" instead of "+str(fidelity))
+            return c
+    return "all tests passed"
+
+
+#checks the stabilizer tableau (method 7) against the statevector on random Clifford circuits, which are
+#deeper and wider than those of random_test: the output weights, the marginals of a few outputs and the
+#support of the samples
+def clifford_test(iterations):
+    for it in range(iterations):
+        size=randint(2,9)
+        c=Circuit.random_circuit(size,randint(1,4*size),[X,Y,Z,H,SqrtNot,CNot])
+        in_v=[randint(0,1) for i in range(size)]
+        weights3=c.run_method3(in_v)
+        weights7=c.run_method7(in_v)
+        if not c.is_clifford() or np.abs(weights7-weights3).max()>1e-12:
+            print("difference detected for input "+str(in_v)+" in:")
+            return c
+
+        outputs=sorted(set(randint(0,size-1) for i in range(randint(1,3))))
+        marginal=weights3.reshape((2,)*size).sum(axis=tuple(i for i in range(size) if i not in outputs)).reshape(-1)
+        if np.abs(c.marginal(in_v,outputs)-marginal).max()>1e-12:
+            print("marginal of outputs "+str(outputs)+" differs for input "+str(in_v)+" in:")
+            return c
+
+        samples=c.sample_method7(in_v,100)
+        if weights3[samples].min()<1e-12:
+            print("impossible outcome sampled for input "+str(in_v)+" in:")
+            return c
+    return "all tests passed"
+
+
+#checks the classical evaluation (method 8) and the truth table against the statevector on random
+#circuits of basis permutations: X, Y, Z, CNot and Toffoli gates and oracles that permute the basis
+#states of up to three qbits with random phases, dense or sparse
+def permutation_test(iterations):
+    for it in range(iterations):
+        size=randint(1,9)
+        c=Circuit(size)
+        last=[(c,i) for i in range(size)]
+        for i in range(randint(1,3*size)):
+            lanes=list(range(size))
+            shuffle(lanes)
+            lanes=lanes[:randint(1,min(3,size))]
+            k=len(lanes)
+            gates=[X(k),Y(k),Z(k)]+[[],[],[CNot()],[T()]][k]
+            if randint(0,1):
+                table=list(range(2**k))
+                shuffle(table)
+                P=np.zeros((2**k,2**k),dtype=np.complex128)
+                P[table,range(2**k)]=np.exp(2j*np.pi*np.random.rand(2**k))
+                gates.append(Gate(choice([Matrix.from_array(P),SparseMatrix.from_dense(P)]),"Oracle "+str(i),True))
+            gate=c.add(choice(gates))
+            for port,lane in enumerate(lanes):
+                c.add_wire(last[lane][0],last[lane][1],gate,port)
+                last[lane]=(gate,port)
+        for i in range(size):
+            c.add_wire(last[i][0],last[i][1],c,i)
+
+        in_v=[randint(0,1) for i in range(size)]
+        weights3=c.run_method3(in_v)
+        if not c.is_classical() or np.abs(c.run_method8(in_v)-weights3).max()>1e-12:
+            print("difference detected for input "+str(in_v)+" in:")
+            return c
+        if weights3[c.truth_table()[int(''.join(map(str, in_v)), 2)]]<1-1e-12:
+            print("truth table differs for input "+str(in_v)+" in:")
+            return c
+    return "all tests passed"
+
+
+#runs one circuit many times with the decision diagrams (method 10). The nodes of earlier states have to
+#be freed, so the runs fit into a few times the nodes of the first one
+def qmdd_test(iterations):
+    from main import qmdd
+    c=Circuit.random_circuit(10,60)
+    nodes=len(c.simulate_qmdd([0]*10).package)
+    limit=qmdd.MAX_NODES
+    qmdd.MAX_NODES=4*nodes
+    try:
+        for it in range(iterations):
+            in_v=[randint(0,1) for i in range(10)]
+            if np.abs(c.run_method10(in_v)-c.run_method3(in_v)).max()>1e-12:
+                print("difference detected for input "+str(in_v)+" in:")
+                return c
+    except RuntimeError as e:
+        print("run "+str(it)+" failed: "+str(e))
+        return c
+    finally:
+        qmdd.MAX_NODES=limit
+    return "all tests passed"
+
+
+#calibrates the cost model and checks it on a chain of size CNot gates on two qbits (e.g. 100000): no
+#method may be estimated at less than a tenth of its time, as it would be if the cost of its steps
+#was fitted to zero, and the chosen method has to be within ten times the fastest one
+def calibration_test(size):
+    from main import cost
+    c=Circuit(2)
+    prev=c
+    for i in range(size):
+        g=c.add_gate(CNot)
+        c.add_wire(prev,0,g,0)
+        c.add_wire(prev,1,g,1)
+        prev=g
+    c.add_wire(prev,0,c,0)
+    c.add_wire(prev,1,c,1)
+    model=cost.CostModel().calibrate()
+    times={}
+    for method,(seconds,memory) in model.estimate(c).items():
+        if seconds>10:
+            continue
+        run=getattr(c,"run_method"+str(method))
+        run([1,0])
+        start=time.time()
+        run([1,0])
+        times[method]=time.time()-start
+        if seconds<times[method]/10:
+            print("method "+str(method)+" was estimated at "+str(seconds)+" seconds but took "+str(times[method]))
+            return c
+    method=model.choose(c)
+    if times[method]>10*min(times.values()):
+        print("method "+str(method)+" was chosen but took "+str(times[method])+" seconds")
+        return c
+    return "all tests passed"
+
+
+#transposes the matrix of one gate of every standard type: the other gates of the type share its
+#arrays, but have to keep their own matrix
+def shared_matrix_test(iterations):
+    for it in range(iterations):
+        for gate_type in (X, Y, Z, H, SqrtNot, QFT):
+            size=randint(1,3)
+            a=gate_type(size)
+            b=gate_type(size)
+            before=b.matrix.data.copy()
+            a.matrix.transpose()
+            if not np.array_equal(b.matrix.data, before) or not np.array_equal(a.matrix.data, before.T):
+                print("transposing one "+a.name+" changed another")
+                return a
+        #these are their own transpose, they only must not share the matrix object
+        for gate_type in (CNot, T):
+            if gate_type().matrix is gate_type().matrix:
+                print("two "+gate_type.__name__+" gates share their matrix")
+                return gate_type()
+    return "all tests passed"
+
+
+#checks that every matrix type transposes itself in place with transpose() and returns a new matrix
+#with transposed(), the factors of a KronOperator are left alone by both
+def transpose_test(iterations):
+    for it in range(iterations):
+        D=Matrix.from_array(np.random.rand(4,4)+1j*np.random.rand(4,4))
+        S=SparseMatrix.from_dense(np.where(np.random.rand(4,4)<0.5, D.data, 0))
+        P=QubitPermutation(np.random.permutation(3))
+        K=KronOperator([D,2,S])
+        factors=[D.data.copy(), S.todense().data.copy()]
+        for M in (D,S,P,K):
+            before=M.todense().data.copy()
+            T=M.transposed()
+            if T is M or not np.array_equal(M.todense().data, before) or not np.array_equal(T.todense().data, before.T):
+                print("transposed() changed the matrix or is wrong:")
+                return M
+            if M.transpose() is not None or not np.array_equal(M.todense().data, before.T):
+                print("transpose() did not transpose the matrix in place:")
+                return M
+            if M is K and (not np.array_equal(D.data, factors[0]) or not np.array_equal(S.todense().data, factors[1])):
+                print("transposing the KronOperator changed its factors")
+                return K
+            M.transpose()
+    return "all tests passed"
+
+
+#extend may only connect free ports: wires from or to a connected port, or two new wires on the same
+#port, have to be rejected before the circuit is changed
+def extend_test(iterations):
+    for it in range(iterations):
+        c=Circuit.random_circuit(randint(3,5),randint(1,10))
+        in_v=[randint(0,1) for i in range(len(c))]
+        weights=c.run_method3(in_v)
+        wires=set(c.wires)
+        gate=choice(c.gates)
+        g=X()
+        h=X()
+        for gates,bad in (([g],[(c,0,g,0),(g,0,c,0)]), ([g],[(gate,0,g,0)]), ([g],[(g,0,gate,0)]),
+                          ([g,h],[(h,0,g,0),(h,0,g,0)])):
+            try:
+                c.extend(gates,bad)
+            except RuntimeError:
+                pass
+            else:
+                print("extend connected a port twice:")
+                return c
+            if set(c.wires)!=wires or g.parent is not None or np.abs(c.run_method3(in_v)-weights).max()>1e-12:
+                print("a rejected extend changed the circuit:")
+                return c
+    return "all tests passed"
+
+
+#converts random circuits to a CircuitGraph and back: the circuit has to give the same output
+#and have the same structure hash
+def graph_test(iterations):
+    from main.graph import CircuitGraph
+    for it in range(iterations):
+        c=Circuit.random_circuit(randint(3,6),randint(1,20))
+        in_v=[randint(0,1) for i in range(len(c))]
+        d=CircuitGraph.from_circuit(c).to_circuit()
+        if d.structure_hash()!=c.structure_hash():
+            print("the structure hash changed for:")
+            return c
+        if np.abs(d.run_method3(in_v)-c.run_method3(in_v)).max()>1e-12:
+            print("difference detected for input "+str(in_v)+" in:")
+            return c
+    return "all tests passed"
+
+
+#fuses random circuits into gates on at most 1 to 4 qbits: the fused circuit has to give the same
+#output, and its gates must not be larger than max_size (or than the largest original gate)
+def fuse_test(iterations):
+    for it in range(iterations):
+        c=Circuit.random_circuit(randint(3,6),randint(1,20))
+        in_v=[randint(0,1) for i in range(len(c))]
+        weights=c.run_method3(in_v)
+        largest=max(len(g.in_wires) for g in c.gates)
+        for k in range(1,5):
+            f=c.fuse(k)
+            if any(len(g.in_wires)>max(k,largest) for g in f.gates) or len(f.gates)>len(c.gates):
+                print("fuse("+str(k)+") built gates that are too large in:")
+                return c
+            if np.abs(f.run_method3(in_v)-weights).max()>1e-12:
+                print("fuse("+str(k)+") changed the output for input "+str(in_v)+" in:")
+                return c
+    return "all tests passed"
+
+
+#memoizes the unitaries of random circuits: a second get_subcircuit of the same structure is a hit with
+#the same matrix, the least recently used entries are evicted beyond max_bytes, and a new cache on the
+#same directory finds the entries of the old one on disk
+def cache_test(iterations):
+    from main.cache import UnitaryCache
+    from main.graph import CircuitGraph
+    import tempfile
+    for it in range(iterations):
+        size=randint(3,5)
+        circuits=[Circuit.random_circuit(size,randint(1,10)) for i in range(3)]
+        keys=[c.structure_hash() for c in circuits]
+        if len(set(keys))<3:
+            continue
+        c=circuits[0]
+        exact=c.get_subcircuit("exact",None).matrix.data
+
+        cache=UnitaryCache()
+        first=c.get_subcircuit("first",cache).matrix.data
+        second=CircuitGraph.from_circuit(c).to_circuit().get_subcircuit("second",cache).matrix.data
+        if (cache.hits,cache.misses)!=(1,1) or not np.array_equal(first,second) or np.abs(first-exact).max()>1e-12:
+            print("the second unitary of the same structure was not a hit with the same matrix:")
+            return c
+
+        #room for two unitaries. The first one is used again before the third one is added
+        cache=UnitaryCache(max_bytes=2*16*4**size)
+        for i in (0,1,0,2):
+            circuits[i].get_subcircuit("gate",cache)
+        if len(cache)!=2 or keys[1] in cache or keys[0] not in cache or keys[2] not in cache:
+            print("the least recently used unitary was not the one evicted:")
+            return circuits[1]
+
+        with tempfile.TemporaryDirectory() as directory:
+            c.get_subcircuit("first",UnitaryCache(directory=directory))
+            cache=UnitaryCache(directory=directory)
+            loaded=c.get_subcircuit("loaded",cache).matrix.data
+            if (cache.hits,cache.misses)!=(1,0) or not np.array_equal(loaded,first):
+                print("the unitary was not found on disk:")
+                return c
+    return "all tests passed"
+
+
+#runs random circuits for several inputs at once: every column of run_batch has to match run_method3
+def batch_test(iterations):
+    for it in range(iterations):
+        c=Circuit.random_circuit(randint(3,6),randint(1,20))
+        inputs=[[randint(0,1) for i in range(len(c))] for j in range(randint(1,5))]
+        for method in (2,3):
+            for in_v,weights in zip(inputs,c.run_batch(inputs,method)):
+                if np.abs(weights-c.run_method3(in_v)).max()>1e-12:
+                    print("run_batch with method "+str(method)+" differs for input "+str(in_v)+" in:")
+                    return c
+    return "all tests passed"
+
+
+#computes single amplitudes of random circuits with the path sum (method 4) and the tensor network
+#(method 5): they have to match the column of the circuit's unitary for the input. Outputs are given
+#as vectors and as integers
+def amplitudes_test(iterations):
+    for it in range(iterations):
+        c=Circuit.random_circuit(randint(3,6),randint(1,20))
+        n=len(c)
+        in_v=[randint(0,1) for i in range(n)]
+        state=c.get_subcircuit("U",None).matrix.data[:,int(''.join(map(str,in_v)),2)]
+        outputs=[randint(0,2**n-1) for i in range(randint(1,4))]
+        out_vs=[Counts.decode(out,n) if randint(0,1) else out for out in outputs]
+        for method in (4,5):
+            amplitudes=c.amplitudes(in_v,out_vs,method)
+            if np.abs(np.array(amplitudes)-state[outputs]).max()>1e-12:
+                print("amplitudes with method "+str(method)+" differ for input "+str(in_v)+" in:")
+                return c
+    return "all tests passed"
+
+
+#samples random circuits: run with shots returns Counts over the circuit's outputs that sum up to
+#the shots, and only outputs of nonzero probability are drawn, with the chosen method and others
+def shots_test(iterations):
+    for it in range(iterations):
+        c=Circuit.random_circuit(randint(3,6),randint(1,20))
+        in_v=[randint(0,1) for i in range(len(c))]
+        weights=c.run_method3(in_v)
+        shots=randint(1,1000)
+        for method in (None,3,6,10):
+            counts=c.run(in_v,method,shots)
+            if not isinstance(counts,Counts) or counts.size!=len(c) or sum(counts.values())!=shots:
+                print("run with method "+str(method)+" did not return "+str(shots)+" counts for:")
+                return c
+            if any(weights[outcome]<1e-12 for outcome in counts):
+                print("run with method "+str(method)+" drew an output of zero probability in:")
+                return c
+    return "all tests passed"
@@ -0,0 +1,464 @@
+from main.matrix import column_nonzeros
+from main import tensornet, mps, stabilizer, classical, sparsestate, qmdd
+from collections import namedtuple
+from itertools import combinations
+import numpy as np
+import json
+import random
+import os
+import time
+
+# Cost model used by Circuit.run to choose a simulation method. Every method (engine) is registered
+# with two estimators that turn the features of a circuit into an abstract operation count and a peak
+# memory use in bytes. The time of a run is estimated as a fixed cost per call, a cost per gate and a
+# cost per operation, plus a cost per operation of every sample drawn. These per-machine coefficients
+# are fitted once to a micro-benchmark of random circuits of several sizes and cached on disk.
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'quantum-circuits', 'cost_model.json')
+
+# Version of the estimators. Coefficients cached for another version are measured again.
+VERSION = 7
+
+# Default memory budget for a single simulation: 4 GB
+MEMORY_BUDGET = 2**32
+
+# Widths of the random calibration circuits, each with CALIBRATION_DEPTHS gates per qbit. The circuits
+# of every depth grow until a run takes CALIBRATION_TIME seconds (or would take much longer), or until
+# the engine needs more than CALIBRATION_MEMORY bytes.
+CALIBRATION_WIDTHS = (3, 4, 6, 8, 12, 16, 24, 32, 48, 64, 96, 128)
+CALIBRATION_DEPTHS = (1, 4)
+# Long circuits on a few qbits with a growing number of gates per qbit, they measure the cost per step
+CALIBRATION_CHAIN_WIDTH = 3
+CALIBRATION_CHAIN_DEPTHS = (4, 16, 64, 256, 1024, 4096)
+CALIBRATION_TIME = 0.02
+CALIBRATION_MEMORY = 2**28
+# Number of samples drawn to measure the cost of sampling
+CALIBRATION_SHOTS = 2**14
+
+
+# Features of a circuit that the estimators use
+#   width: number of qbits, gates: sizes of the gates in topological order, internal: number of internal
+#   wires, columns: largest number of nonzero entries in a column of every gate, classical: fraction of
+#   gates that map basis states to basis states (at most one nonzero entry per column), contraction: a
+#   function that returns the greedy contraction order of the circuit's tensor network (see
+#   tensornet.Contraction), found on the first call as it is by far the most expensive feature, swaps:
+#   the number of swaps of neighbouring lanes that bring the lanes of every gate next to each other,
+#   cuts: for every cut between lanes l - 1 and l (l = 1, ..., width - 1), the log2 of an estimate of
+#   the Schmidt rank of the state across it, at most 2^min(l, width - l) and the number of paths
+Features = namedtuple('Features', ['width', 'gates', 'internal', 'columns', 'classical', 'contraction',
+                                   'swaps', 'cuts'])
+
+# A registered engine: estimators of the operation count and of the memory in bytes, an optional
+# predicate that tells whether the engine can run the circuit at all, and for engines that sample
+# without forming the 2^n output weights (Circuit.sample_methodN) the memory they need for that and the
+# number of operations per sample. Sampling from the output weights takes width + 1 operations per
+# sample. Engines that take more steps than there are gates estimate the number of steps. Engines whose
+# estimators need expensive features give a lower bound of the operation count without them, and are
+# only estimated in full when the bound could beat the other engines (see CostModel.choose).
+Engine = namedtuple('Engine', ['name', 'ops', 'memory', 'available', 'sampling_memory', 'shot_ops', 'steps',
+                               'bound'])
+
+ENGINES = {}
+
+
+def register_engine(method, name, ops, memory, available=None, sampling_memory=None, shot_ops=None,
+                    steps=None, bound=None):
+    ENGINES[method] = Engine(name, ops, memory, available, sampling_memory, shot_ops, steps, bound)
+
+
+# Seconds per call, per step (gate), per operation and per operation of a sample of an engine
+Coefficients = namedtuple('Coefficients', ['call', 'gate', 'op', 'shot'])
+
+# Coefficients of engines that could not be calibrated
+DEFAULT_COEFFICIENTS = Coefficients(1e-4, 1e-5, 1e-8, 1e-8)
+
+
+def features(circuit):
+    plan = circuit.compile()
+    # The standard gates share their matrices, each is looked at once
+    nonzeros = {}
+    for instruction in plan.instructions:
+        M = instruction.matrix
+        if id(M) not in nonzeros:
+            nonzeros[id(M)] = int(column_nonzeros(M).max())
+    columns = [nonzeros[id(instruction.matrix)] for instruction in plan.instructions]
+    gates = [len(instruction.lanes) for instruction in plan.instructions]
+    classical = sum(1 for c in columns if c == 1) / len(columns) if columns else 1.
+    swaps = sum(max(instruction.lanes) - min(instruction.lanes) + 1 - len(instruction.lanes)
+                for instruction in plan.instructions)
+    # A gate with a of its lanes above a cut and b below it multiplies the rank of a product state by
+    # 2^min(a, b), entangled states can take up to 4^min(a, b). The gates add to the cuts between their
+    # lanes through the differences of neighbouring cuts.
+    n = len(circuit)
+    differences = np.zeros(n + 1)
+    for instruction in plan.instructions:
+        lanes = sorted(instruction.lanes)
+        for a in range(1, len(lanes)):
+            bits = min(a, len(lanes) - a)
+            differences[lanes[a - 1] + 1] += bits
+            differences[lanes[a] + 1] -= bits
+    paths = np.log2([float(c) for c in columns]).sum()
+    cuts = np.minimum(np.cumsum(differences)[1:n], np.minimum(np.arange(1, n), n - np.arange(1, n)))
+    cuts = np.minimum(cuts, paths)
+    return Features(n, gates, len(circuit.get_internal_wires()), columns, classical,
+                    lambda: tensornet.estimate(circuit), swaps, [float(cut) for cut in cuts])
+
+
+# Estimators of the built-in engines. Every engine returns all 2^n output weights, the matrix product
+# state, the stabilizer tableau, the classical evaluation, the sparse state and the decision diagram
+# can also sample without them.
+def _paths(f):
+    paths = 1
+    for c in f.columns:
+        paths *= c
+    return paths
+
+register_engine(1, 'Feynman',
+                lambda f: len(f.gates) * 2**(f.width + f.internal),
+                lambda f: 8 * 2**f.width + 48 * 2**16)
+register_engine(2, 'matrix multiplication',
+                lambda f: sum(2 * 2**f.width + 2**(f.width + k) for k in f.gates),
+                lambda f: 4 * 16 * 2**f.width)
+register_engine(3, 'statevector',
+                lambda f: sum(2**(f.width + k) for k in f.gates),
+                lambda f: 3 * 16 * 2**f.width)
+register_engine(4, 'path sum',
+                lambda f: max(len(f.gates), 1) * _paths(f),
+                lambda f: 8 * 2**f.width + 64 * len(f.gates) * max(f.columns, default=1))
+# Upper bound of the bond dimension of the matrix product state: every gate multiplies the Schmidt rank
+# by at most the number of nonzero entries in its columns. If the bound exceeds mps.MAX_BOND the result
+# is approximate, so the engine is only chosen automatically when no exact one fits. Every gate and
+# every swap that brings its qbits next to each other is one decomposition of a bond; the swaps are
+# counted from the lanes the qbits start on. Sampling goes site by site for all samples at once.
+def _bond(f):
+    return min(_paths(f), 2**(f.width // 2))
+
+def _mps_steps(f):
+    return len(f.gates) + f.swaps
+
+def _mps_ops(f):
+    if _bond(f) > mps.MAX_BOND:
+        return float('inf')
+    return max(_mps_steps(f), 1) * _bond(f)**3
+
+def _mps_memory(f):
+    return 4 * 16 * f.width * min(_bond(f), mps.MAX_BOND)**2
+
+# Every gate tensor takes part in a contraction at least as large as itself, the last one gives the 2^n
+# output amplitudes
+register_engine(5, 'tensor network',
+                lambda f: f.contraction().flops,
+                lambda f: 3 * 16 * 2**f.contraction().width,
+                bound=lambda f: max(sum(4**k for k in f.gates), 2**f.width))
+register_engine(6, 'matrix product state',
+                _mps_ops,
+                lambda f: _mps_memory(f) + 16 * 2**f.width,
+                sampling_memory=_mps_memory,
+                shot_ops=lambda f: f.width,
+                steps=_mps_steps)
+
+# The stabilizer tableau only runs Clifford circuits. Every gate updates O(n) bits. Measuring an output
+# takes about as long as three gates, the random outcomes (as many as the rank of the output
+# distribution) update O(n^2) bits each. The rank is at most one per gate that creates a superposition,
+# and a sample combines as many random bits.
+def _rank(f):
+    return min(f.width, _paths(f).bit_length() - 1)
+
+def _tableau_memory(f):
+    return 3 * (2 * f.width + 1) * (f.width + 1)
+
+register_engine(7, 'stabilizer',
+                lambda f: len(f.gates) * f.width + (_rank(f) + 1) * f.width**2,
+                lambda f: _tableau_memory(f) + 8 * 2**f.width,
+                available=lambda circuit: stabilizer.program(circuit) is not None,
+                sampling_memory=_tableau_memory,
+                shot_ops=lambda f: f.width * (_rank(f) + 1),
+                steps=lambda f: len(f.gates) + 3 * f.width)
+# Classical circuits are evaluated with bit operations on one integer
+register_engine(8, 'classical',
+                lambda f: len(f.gates) + f.width,
+                lambda f: 8 * 2**f.width,
+                available=lambda circuit: classical.program(circuit) is not None,
+                sampling_memory=lambda f: 8 * f.width,
+                shot_ops=lambda f: 1)
+
+# The sparse state holds at most as many amplitudes as there are paths through the circuit, and turns
+# dense beyond sparsestate.DENSITY of them
+def _states(f):
+    return min(_paths(f), 2**f.width)
+
+def _sparse_memory(f):
+    if _states(f) > sparsestate.DENSITY * 2**f.width:
+        return 3 * 16 * 2**f.width
+    return 96 * _states(f)
+
+register_engine(9, 'sparse state',
+                lambda f: max(len(f.gates), 1) * _states(f),
+                lambda f: _sparse_memory(f) + 8 * 2**f.width,
+                available=lambda circuit: len(circuit) <= sparsestate.MAX_WIDTH,
+                sampling_memory=_sparse_memory,
+                shot_ops=lambda f: f.width + 1)
+
+# A decision diagram has as many nodes on a level as there are distinct sub-vectors below it, about the
+# Schmidt rank across the cut above the level. Dense circuits reach the rank estimates, circuits with
+# structure share more nodes. Every gate walks the levels from the top down to its lanes, and a gate on
+# k qbits multiplies the nodes of the state with the up to 4^k nodes of its own diagram. The memory is
+# limited by qmdd.MAX_NODES.
+def _diagram_nodes(f):
+    return 1 + sum(2**cut for cut in f.cuts)
+
+def _diagram_memory(f):
+    return qmdd.NODE_BYTES * min(_diagram_nodes(f), qmdd.MAX_NODES)
+
+register_engine(10, 'decision diagram',
+                lambda f: max(sum(4**k for k in f.gates), 1) * _diagram_nodes(f),
+                lambda f: _diagram_memory(f) + 16 * 2**f.width,
+                available=lambda circuit: len(circuit) <= qmdd.MAX_WIDTH,
+                sampling_memory=_diagram_memory,
+                shot_ops=lambda f: f.width,
+                steps=lambda f: len(f.gates) * f.width)
+
+
+# Operation counts of the exponential engines can be too large for a float
+def _seconds(ops, coefficient):
+    if ops == float('inf'):
+        return ops
+    try:
+        return ops * coefficient
+    except OverflowError:
+        return float('inf')
+
+
+# Steps of the engine: one per gate unless it estimates its own
+def _steps(engine, f):
+    if engine.steps is not None:
+        return engine.steps(f)
+    return len(f.gates)
+
+
+# Operations per sample of the engine: its own sampler's, or those of sampling from the output weights
+def _shot_ops(engine, f):
+    if engine.shot_ops is not None:
+        return engine.shot_ops(f)
+    return f.width + 1
+
+
+# Fits the coefficients of seconds = call + gate * steps + op * ops to the measured points (steps, ops,
+# seconds), minimizing the relative error. The coefficients must not be negative: with three terms the
+# non-negative least squares solution is the best unconstrained solution, over every subset of the
+# terms, that has no negative coefficient.
+def _fit(points):
+    A = np.array([[1., steps, ops] for steps, ops, seconds in points])
+    seconds = np.array([seconds for steps, ops, seconds in points])
+    A /= seconds[:, None]
+    scale = A.max(axis=0)
+    A /= scale
+    b = np.ones(len(points))
+    best, best_error = np.zeros(3), float(b @ b)
+    for k in range(1, 4):
+        for terms in combinations(range(3), k):
+            terms = list(terms)
+            x = np.linalg.lstsq(A[:, terms], b, rcond=None)[0]
+            if (x < 0).any():
+                continue
+            error = float(np.sum((A[:, terms] @ x - b) ** 2))
+            if error < best_error:
+                best, best_error = np.zeros(3), error
+                best[terms] = x
+    return [float(x) for x in best / scale]
+
+
+# Returns the fastest of repeats runs, after one run that fills the caches
+def _time(run, repeats):
+    run()
+    best = float('inf')
+    for i in range(repeats):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class CostModel(object):
+    def __init__(self, coefficients=None, memory_budget=MEMORY_BUDGET):
+        # Coefficients of every engine. Uncalibrated engines use DEFAULT_COEFFICIENTS.
+        self.coefficients = {method: Coefficients(*c) for method, c in (coefficients or {}).items()}
+        self.memory_budget = memory_budget
+        self._last = (None, None)
+
+    def _features(self, circuit):
+        plan = circuit.compile()
+        if self._last[0] is not plan:
+            self._last = (plan, features(circuit))
+        return self._last[1]
+
+    def _seconds(self, method, engine, f, sampling, shots, ops=None):
+        c = self.coefficients.get(method, DEFAULT_COEFFICIENTS)
+        ops = engine.ops(f) if ops is None else ops
+        seconds = c.call + c.gate * _steps(engine, f) + _seconds(ops, c.op)
+        if sampling:
+            seconds += _seconds(shots * _shot_ops(engine, f), c.shot)
+        return seconds
+
+    # Returns a dictionary of method: (estimated seconds, estimated bytes) for all available engines.
+    # With sampling, the time includes drawing shots samples and the memory is that of drawing samples
+    # rather than computing all output weights.
+    def estimate(self, circuit, sampling=False, shots=1):
+        f = self._features(circuit)
+        estimates = {}
+        for method, engine in ENGINES.items():
+            if engine.available is not None and not engine.available(circuit):
+                continue
+            estimates[method] = (self._seconds(method, engine, f, sampling, shots),
+                                 self._memory(engine, f, sampling))
+        return estimates
+
+    def _memory(self, engine, f, sampling):
+        if sampling and engine.sampling_memory is not None:
+            return engine.sampling_memory(f)
+        return engine.memory(f)
+
+    # Returns the fastest method (of the given ones, or of all) that fits into the memory budget. Engines
+    # with a lower bound come last and are skipped if the bound is no faster than the best engine so far.
+    def choose(self, circuit, sampling=False, shots=1, methods=None):
+        f = self._features(circuit)
+        best, best_seconds = None, float('inf')
+        for method, engine in sorted(ENGINES.items(), key=lambda item: item[1].bound is not None):
+            if methods is not None and method not in methods:
+                continue
+            if engine.available is not None and not engine.available(circuit):
+                continue
+            if engine.bound is not None:
+                if self._seconds(method, engine, f, sampling, shots, engine.bound(f)) >= best_seconds:
+                    continue
+            if self._memory(engine, f, sampling) > self.memory_budget:
+                continue
+            seconds = self._seconds(method, engine, f, sampling, shots)
+            if seconds < best_seconds or best is None:
+                best, best_seconds = method, seconds
+        if best is None:
+            raise RuntimeError("Cannot run the circuit: every method needs more than {0} bytes of memory."
+                               .format(self.memory_budget))
+        return best
+
+    # Raises an error if the method cannot run the circuit within the memory budget
+    def check(self, circuit, method, sampling=False):
+        if method not in ENGINES:
+            raise RuntimeError("Please choose one of the avalible methods: " + ", ".join(map(str, sorted(ENGINES))))
+        engine = ENGINES[method]
+        if engine.available is not None and not engine.available(circuit):
+            raise RuntimeError("Method {0} ({1}) cannot run this circuit.".format(method, engine.name))
+        memory = self._memory(engine, self._features(circuit), sampling)
+        if memory > self.memory_budget:
+            raise RuntimeError("Method {0} ({1}) would need {2} bytes of memory, the budget is {3}."
+                               .format(method, engine.name, memory, self.memory_budget))
+
+    # Measures the coefficients of every engine on random circuits of growing size. Engines that only
+    # run Clifford or classical circuits get random circuits of such gates. Every circuit is run once to
+    # fill the caches, then the fastest of repeats runs counts. Engines with a sampler of their own are
+    # timed drawing one sample, as Circuit.run does, which also allows circuits too wide for the output
+    # weights.
+    def calibrate(self, repeats=3):
+        from main.circuit import Circuit, X, Y, Z, H, CNot, T, sample_weights
+
+        # The benchmark circuits are always the same and the caller's random state is left untouched
+        state = random.getstate()
+        families = (None, (X, Y, Z, H, CNot), (X, CNot, T))
+        circuits = {}
+        def benchmark(family, width, depth):
+            if (family, width, depth) not in circuits:
+                random.seed('%d %d %d' % (family, width, depth))
+                c = Circuit.random_circuit(width, width * depth, families[family])
+                circuits[family, width, depth] = (c, [random.randint(0, 1) for _ in range(width)], features(c))
+            return circuits[family, width, depth]
+
+        try:
+            for method, engine in ENGINES.items():
+                sampler = 'sample_method%d' % method if engine.sampling_memory is not None else None
+                points, largest = [], None
+                # The chains come first, the widest circuit measures the cost of sampling
+                series = [[(CALIBRATION_CHAIN_WIDTH, depth) for depth in CALIBRATION_CHAIN_DEPTHS]]
+                series += [[(width, depth) for width in CALIBRATION_WIDTHS] for depth in CALIBRATION_DEPTHS]
+                for sizes in series:
+                    last = None
+                    for width, depth in sizes:
+                        for family in range(len(families)):
+                            c, in_v, f = benchmark(family, width, depth)
+                            if engine.available is None or engine.available(c):
+                                break
+                        else:
+                            break
+                        ops = engine.ops(f)
+                        if ops == float('inf') or self._memory(engine, f, sampler is not None) > CALIBRATION_MEMORY:
+                            break
+                        # Linear extrapolation from the last circuit overestimates the time
+                        if last is not None:
+                            limit = 10 * CALIBRATION_TIME / last[2]
+                            if ops > limit * max(last[1], 1) or _steps(engine, f) > limit * max(last[0], 1):
+                                break
+                        if sampler is None:
+                            run = lambda: getattr(c, 'run_method%d' % method)(in_v)
+                        else:
+                            run = lambda: getattr(c, sampler)(in_v, 1)
+                        last = (_steps(engine, f), ops, _time(run, repeats))
+                        points.append(last)
+                        largest = (c, in_v, f, last[2])
+                        if last[2] > CALIBRATION_TIME:
+                            break
+                if not points:
+                    # None of the benchmark circuits suits the engine, it keeps the default coefficients
+                    self.coefficients.setdefault(method, DEFAULT_COEFFICIENTS)
+                    continue
+
+                # The cost of sampling is the difference between drawing many samples and drawing one
+                c, in_v, f, seconds = largest
+                if sampler is None:
+                    weights = getattr(c, 'run_method%d' % method)(in_v)
+                    rng = np.random.default_rng(0)
+                    one = _time(lambda: sample_weights(weights, 1, rng), repeats)
+                    many = _time(lambda: sample_weights(weights, CALIBRATION_SHOTS, rng), repeats)
+                else:
+                    one = seconds
+                    many = _time(lambda: getattr(c, sampler)(in_v, CALIBRATION_SHOTS), repeats)
+                shot = max(many - one, 0.) / ((CALIBRATION_SHOTS - 1) * _shot_ops(engine, f))
+                self.coefficients[method] = Coefficients(*_fit(points), shot)
+        finally:
+            random.setstate(state)
+        return self
+
+    def save(self, path=CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'version': VERSION,
+                       'coefficients': {str(method): list(c) for method, c in self.coefficients.items()}}, f)
+
+    # Loads the coefficients cached at path. If there are none (or some engine is missing, or they were
+    # measured for another version of the estimators), the model is calibrated and the result is cached.
+    @classmethod
+    def load(cls, path=CACHE_PATH):
+        model = cls()
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached['version'] == VERSION:
+                model.coefficients = {int(method): Coefficients(*c) for method, c in cached['coefficients'].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        if any(method not in model.coefficients for method in ENGINES):
+            model.calibrate()
+            try:
+                model.save(path)
+            except OSError:
+                pass
+        return model
+
+
+_model = None
+
+
+# Returns the cost model shared by all circuits, loading or calibrating it on first use
+def get_model():
+    global _model
+    if _model is None:
+        _model = CostModel.load()
+    return _model
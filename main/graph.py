@@ -0,0 +1,297 @@
+from main.circuit import Circuit, Gate, kahn_order
+from main.matrix import matrix_key
+from array import array
+import numpy as np
+
+# Compact representation of large circuits. A Circuit keeps a Python object for every gate and wire,
+# which costs hundreds of bytes each. CircuitGraph stores the same information in typed arrays (a few
+# dozen bytes per gate) and hands out small views with the attributes of Gate and Wire when they are
+# asked for. Gate matrices are not copied: gates of the same type whose matrices are views of one matrix
+# (see Matrix.view) share one entry of CircuitGraph.types.
+#
+# Gates are numbered 0, 1, ... in the order they are added and the ports of gate i are numbered from
+# offset[i] on. The circuit's own inputs and outputs are the endpoints of gate CIRCUIT. A CircuitGraph
+# only grows, gates and wires cannot be removed.
+
+CIRCUIT = -1
+
+
+# A gate of a CircuitGraph. Compares equal to other views of the same gate.
+class GateView(object):
+    __slots__ = ('graph', 'index')
+
+    def __init__(self, graph, index):
+        self.graph = graph
+        self.index = index
+
+    def __len__(self):
+        return self.graph.offset[self.index + 1] - self.graph.offset[self.index]
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        if isinstance(other, GateView):
+            return self.graph is other.graph and self.index == other.index
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, GateView):
+            return not self == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.graph), self.index))
+
+    @property
+    def name(self):
+        return self.graph.names[self.graph.gate_name[self.index]]
+
+    @property
+    def type(self):
+        return self.graph.types[self.graph.gate_type[self.index]][0]
+
+    @property
+    def matrix(self):
+        return self.graph.types[self.graph.gate_type[self.index]][1]
+
+    @property
+    def in_wires(self):
+        return self.graph._wire_views(self.graph.in_wire, self.graph.offset[self.index], len(self))
+
+    @property
+    def out_wires(self):
+        return self.graph._wire_views(self.graph.out_wire, self.graph.offset[self.index], len(self))
+
+    def get_matrix(self):
+        return self.matrix.copy()
+
+
+# A wire of a CircuitGraph. left and right are gate views, or the graph itself for the circuit's inputs
+# and outputs, as with Wire.
+class WireView(object):
+    __slots__ = ('graph', 'index')
+
+    def __init__(self, graph, index):
+        self.graph = graph
+        self.index = index
+
+    def __str__(self):
+        return str(self.left) + " --> " + str(self.right)
+
+    def __eq__(self, other):
+        if isinstance(other, WireView):
+            return self.graph is other.graph and self.index == other.index
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, WireView):
+            return not self == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.graph), self.index))
+
+    @property
+    def left(self):
+        return self.graph._component(self.graph.wire_left[self.index])
+
+    @property
+    def right(self):
+        return self.graph._component(self.graph.wire_right[self.index])
+
+    @property
+    def lind(self):
+        return self.graph.wire_lind[self.index]
+
+    @property
+    def rind(self):
+        return self.graph.wire_rind[self.index]
+
+    def is_internal(self):
+        return self.graph.wire_left[self.index] != CIRCUIT and self.graph.wire_right[self.index] != CIRCUIT
+
+
+class CircuitGraph(object):
+    def __init__(self, size):
+        # Gate types (class, matrix) and names, each stored once
+        self.types = []
+        self.names = []
+        self._type_ids = {}
+        self._name_ids = {}
+
+        # Per gate: type, name and the number of its first port (offset has one more entry)
+        self.gate_type = array('i')
+        self.gate_name = array('i')
+        self.offset = array('i', [0])
+
+        # Per port: the wire connected to the input and to the output with that number, -1 if none.
+        # input and output hold the wires at the circuit's own inputs and outputs.
+        self.in_wire = array('i')
+        self.out_wire = array('i')
+        self.input = array('i', [-1] * size)
+        self.output = array('i', [-1] * size)
+
+        # Per wire: the gates and ports it connects
+        self.wire_left = array('i')
+        self.wire_lind = array('i')
+        self.wire_right = array('i')
+        self.wire_rind = array('i')
+
+    def __len__(self):
+        return len(self.input)
+
+    def __iter__(self):
+        return (GateView(self, i) for i in range(self.gate_count))
+
+    @property
+    def gate_count(self):
+        return len(self.gate_type)
+
+    @property
+    def wire_count(self):
+        return len(self.wire_left)
+
+    # Bytes taken up by the arrays (the gate matrices and names are not counted)
+    @property
+    def nbytes(self):
+        arrays = (self.gate_type, self.gate_name, self.offset, self.in_wire, self.out_wire, self.input,
+                  self.output, self.wire_left, self.wire_lind, self.wire_right, self.wire_rind)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    def gate(self, index):
+        return GateView(self, index)
+
+    def wire(self, index):
+        return WireView(self, index)
+
+    @property
+    def wires(self):
+        return [WireView(self, i) for i in range(self.wire_count)]
+
+    def _component(self, index):
+        return self if index == CIRCUIT else GateView(self, index)
+
+    def _wire_views(self, ports, start, size):
+        return [WireView(self, ports[p]) if ports[p] >= 0 else None for p in range(start, start + size)]
+
+    # Adds a gate with the given matrix and returns its index. cls is the Gate class used by to_circuit.
+    def add_gate(self, matrix, name, cls=Gate):
+        key = (cls, matrix_key(matrix))
+        if key not in self._type_ids:
+            self._type_ids[key] = len(self.types)
+            self.types.append((cls, matrix))
+        if name not in self._name_ids:
+            self._name_ids[name] = len(self.names)
+            self.names.append(name)
+
+        size = len(matrix).bit_length() - 1
+        self.gate_type.append(self._type_ids[key])
+        self.gate_name.append(self._name_ids[name])
+        self.offset.append(self.offset[-1] + size)
+        self.in_wire.extend([-1] * size)
+        self.out_wire.extend([-1] * size)
+        return self.gate_count - 1
+
+    def _index(self, component):
+        if component is self:
+            return CIRCUIT
+        if isinstance(component, GateView):
+            return component.index
+        return component
+
+    # Connects the from_port-th output of from_gate to the to_port-th input of to_gate and returns the
+    # index of the wire. Gates are given by index or view, CIRCUIT (or the graph) stands for the circuit.
+    def add_wire(self, from_gate, from_port, to_gate, to_port):
+        from_gate = self._index(from_gate)
+        to_gate = self._index(to_gate)
+        for gate in (from_gate, to_gate):
+            if not CIRCUIT <= gate < self.gate_count:
+                raise RuntimeError("Cannot add wire: {0} is not a valid component.".format(gate))
+        if from_port >= self._size(from_gate):
+            raise RuntimeError("Cannot add wire: gate {0} does not have {1} output ports.".format(from_gate, from_port+1))
+        if to_port >= self._size(to_gate):
+            raise RuntimeError("Cannot add wire: gate {0} does not have {1} input ports.".format(to_gate, to_port+1))
+
+        w = self.wire_count
+        self.wire_left.append(from_gate)
+        self.wire_lind.append(from_port)
+        self.wire_right.append(to_gate)
+        self.wire_rind.append(to_port)
+        if from_gate == CIRCUIT:
+            self.input[from_port] = w
+        else:
+            self.out_wire[self.offset[from_gate] + from_port] = w
+        if to_gate == CIRCUIT:
+            self.output[to_port] = w
+        else:
+            self.in_wire[self.offset[to_gate] + to_port] = w
+        return w
+
+    def _size(self, gate):
+        return len(self) if gate == CIRCUIT else self.offset[gate + 1] - self.offset[gate]
+
+    # Returns the gate indices in topological order (see kahn_order), computed from the wire arrays.
+    # Raises an error if the circuit contains a cycle.
+    def order(self):
+        left = np.frombuffer(self.wire_left, dtype=np.int32)
+        right = np.frombuffer(self.wire_right, dtype=np.int32)
+        internal = (left != CIRCUIT) & (right != CIRCUIT)
+        left, right = left[internal], right[internal]
+
+        # Successors of every gate in CSR form
+        n = self.gate_count
+        by_left = np.argsort(left, kind='stable')
+        successors = right[by_left].tolist()
+        start = np.concatenate(([0], np.cumsum(np.bincount(left, minlength=n)))).tolist()
+        indegree = np.bincount(right, minlength=n).tolist()
+
+        order = kahn_order(indegree, lambda g: successors[start[g]:start[g + 1]])
+        if len(order) != n:
+            raise RuntimeError("Cannot sort - the circuit contains a cycle.")
+        return np.array(order, dtype=np.int64)
+
+    def contains_cycle(self):
+        try:
+            self.order()
+        except RuntimeError:
+            return True
+        return False
+
+    # Check the circuit is a proper quantum circuit
+    def check(self):
+        return (
+            min(self.input, default=0) >= 0 and
+            min(self.output, default=0) >= 0 and
+            min(self.in_wire, default=0) >= 0 and
+            min(self.out_wire, default=0) >= 0 and
+            not self.contains_cycle()
+        )
+
+    @classmethod
+    def from_circuit(cls, circuit):
+        graph = cls(len(circuit))
+        index = {}
+        for g in circuit.gates:
+            index[g.key] = graph.add_gate(g.matrix, g.name, type(g))
+        for w in circuit.wires:
+            graph.add_wire(CIRCUIT if w.left is circuit else index[w.left.key], w.lind,
+                           CIRCUIT if w.right is circuit else index[w.right.key], w.rind)
+        return graph
+
+    # Builds an equivalent Circuit. The gates get the classes they were added with and views of the
+    # (shared) matrices, see Matrix.view.
+    def to_circuit(self):
+        c = Circuit(len(self))
+        gates = []
+        for t, name in zip(self.gate_type, self.gate_name):
+            gate_cls, matrix = self.types[t]
+            gate = gate_cls.__new__(gate_cls)
+            Gate.__init__(gate, matrix.view(), self.names[name], True)
+            gates.append(gate)
+
+        endpoint = lambda g: c if g == CIRCUIT else gates[g]
+        wires = [(endpoint(l), li, endpoint(r), ri) for l, li, r, ri in
+                 zip(self.wire_left, self.wire_lind, self.wire_right, self.wire_rind)]
+        c.extend(gates, wires)
+        return c
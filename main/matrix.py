@@ -1,15 +1,53 @@
 import cmath
-from itertools import product
+import numpy as np
 
 #this is a helpful external function that computes the tensor product of a list of matrices
-#in the order given by the list
-def tensor(matrixlist):
+#in the order given by the list. If lazy is set, the product is not built - a KronOperator is returned
+def tensor(matrixlist, lazy=False):
+    if lazy:
+        return KronOperator(matrixlist)
     T=(matrixlist[0]).bintensor(matrixlist[1])
     for i in range(2,len(matrixlist)):
         T=T.bintensor(matrixlist[i])
 
     return T   
 
+#applies the matrix M (of any of the matrix types below) to the given axes of the 2x2x...x2 tensor T.
+#The first axis corresponds to the most significant bit of M's row/column index.
+def apply_to_axes(M, T, axes):
+    k=len(axes)
+    T=np.moveaxis(T, axes, range(k))
+    shape=T.shape
+    T=M.dot(T.reshape(2**k, -1)).reshape(shape)
+    return np.moveaxis(T, range(k), axes)
+
+#returns the number of nonzero entries in every column of M (of any of the matrix types below)
+def column_nonzeros(M):
+    if isinstance(M, Matrix):
+        return np.count_nonzero(M.data, axis=0)
+    if isinstance(M, SparseMatrix):
+        return np.bincount(M.indices, minlength=M.shape[1])
+    if isinstance(M, QubitPermutation):
+        return np.ones(len(M), dtype=np.int64)
+    if isinstance(M, KronOperator):
+        counts=np.ones(1, dtype=np.int64)
+        for factor in M.factors:
+            factor_counts=np.ones(factor, dtype=np.int64) if isinstance(factor, int) else column_nonzeros(factor)
+            counts=np.kron(counts, factor_counts)
+        return counts
+    return np.count_nonzero(M.todense().data, axis=0)
+
+#returns a key that is the same for all views of a matrix (see Matrix.view) as long as they are alive and
+#not transposed, so values computed from a matrix can be kept once for all of its views
+def matrix_key(M):
+    if isinstance(M, Matrix):
+        return (id(M.data),)
+    if isinstance(M, SparseMatrix):
+        return (id(M.indptr), id(M.indices), id(M.values))
+    if isinstance(M, QubitPermutation):
+        return (id(M.qubits),)
+    return (id(M),)
+
 def matrix_product(matrixlist):
     I=Matrix.Id(len(matrixlist[0]))
     for M in matrixlist:
@@ -17,32 +55,72 @@ def matrix_product(matrixlist):
         
     return I
 
+#for every basis index y returns the index z whose bit k (counting from the most significant one)
+#is bit permutation[k] of y
+def _permuted_indices(permutation):
+    n=len(permutation)
+    y=np.arange(2**n, dtype=np.int64)
+    z=np.zeros(2**n, dtype=np.int64)
+    for k, i in enumerate(permutation):
+        z|=((y >> (n-1-i)) & 1) << (n-1-k)
+    return z
+
 class MatrixError(Exception):
     """ An exception class for Matrix """
     pass
 
-#class for matrices
+#class for matrices. The entries are kept in a contiguous complex128 numpy array (self.data),
+#so products go through BLAS and tensor products through np.kron
 class Matrix(object):
     def __init__(self, rows):
-        if rows==[]:
+        if len(rows)==0:
             raise MatrixError('Please specify the rows of the matrix.')
-        for i in range(len(rows)-1):
-            if len(rows[i])!=len(rows[i+1]):
-                raise MatrixError('Row dimensions are not consistent.')
-        self.rows = rows
+        try:
+            data=np.array(rows, dtype=np.complex128)
+        except ValueError:
+            raise MatrixError('Row dimensions are not consistent.')
+        if data.ndim!=2:
+            raise MatrixError('Row dimensions are not consistent.')
+        self.data=data
+
+    #wraps an existing 2D array without copying it
+    @classmethod
+    def from_array(cls, data):
+        M=cls.__new__(cls)
+        M.data=np.ascontiguousarray(data, dtype=np.complex128)
+        return M
+
+    #matrices pickled before the numpy backend stored a list of rows
+    def __setstate__(self, state):
+        if 'rows' in state:
+            state['data']=np.array(state.pop('rows'), dtype=np.complex128)
+        self.__dict__.update(state)
+
+    #the rows as python lists. This is a copy - use item access or self.data to modify the matrix
+    @property
+    def rows(self):
+        return self.data.tolist()
+
+    @rows.setter
+    def rows(self, rows):
+        self.data=Matrix(rows).data
+
+    @property
+    def shape(self):
+        return self.data.shape
 
     def __len__(self):
-        return len(self.rows)
+        return len(self.data)
 
     def __getitem__(self, i):
-        return self.rows[i]
+        return self.data[i]
 
     def __setitem__(self, i, item):
-        self.rows[i]=item
+        self.data[i]=item
 
     def __str__(self):
         string=''
-        for i in self.rows:
+        for i in self.data:
             for j in i:
                 string+=str(j)+' '
             string+='\n'
@@ -55,78 +133,76 @@ class Matrix(object):
         return rep
 
     def __eq__(self, M):
-        return (M.rows == self.rows)
+        if not isinstance(M, Matrix):
+            return NotImplemented
+        return np.array_equal(self.data, M.data)
 
     def __mul__(self, M):
-        if len(self.rows[0])!=len(M):
+        if not isinstance(M, Matrix):
+            return NotImplemented
+        if self.data.shape[1]!=len(M):
             raise MatrixError('Matrix dimensions must agree.')
 
-        result = Matrix([[0]*len(M.rows[0]) for x in range(len(self))])
-        for i in range(len(self)):
-            for j in range(len(M.rows[0])):
-                column=[k[j] for k in M.rows]
-                result[i][j] = sum([item[0]*item[1] for item in zip(self.rows[i], column)])
+        return Matrix.from_array(self.data @ M.data)
+
+    #multiplies the matrix with a 2D numpy array and returns a numpy array
+    def dot(self, X):
+        return self.data @ X
+
+    def copy(self):
+        return Matrix.from_array(self.data.copy())
+
+    #a new matrix object over the same array. Transposing it rebinds its own array only, so gates can hold
+    #views of one read-only matrix
+    def view(self):
+        return Matrix.from_array(self.data)
+
+    def todense(self):
+        return self
 
-        return result
-    
     #round all entries of the matrix to a number of places to prevent numerical malfunctions
     def Round(self, places):
-        M=Matrix.Zero(len(self))
-        for i in range(len(M)):
-            for j in range(len(M.rows[0])):
-                M[i][j]=round(self[i][j].real, places)
-        return M
+        return Matrix.from_array(np.round(self.data.real, places))
 
+    #every matrix type transposes itself in place with transpose() and returns a new transposed matrix
+    #with transposed(), which leaves the matrix and the arrays it shares with its views alone
     def transpose(self):
-        self.rows=[list(item) for item in zip(*self.rows)]
+        self.data=np.ascontiguousarray(self.data.T)
+
+    def transposed(self):
+        return Matrix.from_array(self.data.T)
         
     def getConjugate(self):
-        M=Matrix.Zero(len(self))
-        for i in range(len(M)):
-            for j in range(len(M.rows[0])):
-                M[j][i]=(self[i][j]).conjugate()
-        return M
+        return Matrix.from_array(self.data.conj().T)
     
     def isUnitary(self):
-        if (self*(self.getConjugate())).Round(12)==Matrix.Id(len(self)):
-            return True
-        else:
+        n, m=self.data.shape
+        if n!=m:
             return False
+        return np.allclose(self.data @ self.data.conj().T, np.eye(n), rtol=0, atol=1e-12)
     
     #returns the tensor product of self and M. Will mostly use tensor() function for tensor products
     #this is only the basis for it
     def bintensor(self,M):
-        m=len(self)
-        n=len(self.rows[0])
-        p=len(M)
-        q=len(M.rows[0])
-        
-        T=Matrix.Zero(m*p,n*q)
-        
-        for i in range(0,m*p,p):
-            for j in range(0,n*q,q):
-                for k in range(p):
-                    for l in range(q):
-                        T[i+k][j+l]=(self[int(i/p)][int(j/q)])*(M[k][l])
-                        
-        return T        
+        if isinstance(M, KronOperator):
+            return KronOperator([self]+M.factors)
+        if isinstance(M, SparseMatrix):
+            return SparseMatrix.from_dense(self).bintensor(M)
+        return Matrix.from_array(np.kron(self.data, M.data))
     
     #multiplies self(vector) with a list of matrices in the order of the list
     def apply(self, matrices):
-        if len(self.rows[0])>1:
+        if self.data.shape[1]>1:
             raise MatrixError("This method is reserved for vectors.")
         
-        M=Matrix.vector([0 for i in range(len(self))])
-        for i in range(len(M)):
-            M[i][0]=self[i][0]
-                
+        M=self.copy()
         for N in matrices:
             M=N*M
             
         return M
 
     #these are class methods for quickly generating the matrices needed in the project.
-    #Add more if needed.
+    #Add more if needed. With lazy=True, the multi-qubit versions return a KronOperator.
     @classmethod
     def vector(cls, column):
         M=Matrix([column])
@@ -137,103 +213,83 @@ class Matrix(object):
     def Zero(cls,nrows,ncolumns=0):
         if ncolumns==0:
             ncolumns=nrows
-        rows=[[0]*ncolumns for x in range(nrows)]
-        return cls(rows)
+        return cls.from_array(np.zeros((nrows, ncolumns), dtype=np.complex128))
         
     @classmethod
     def Id(cls,size):
-        rows=[[0]*size for x in range(size)]
-        for i in range(size):
-            rows[i][i]=1
-
-        return cls(rows)
+        return cls.from_array(np.eye(size, dtype=np.complex128))
     
     @classmethod
-    def H(cls, size=1):
+    def H(cls, size=1, lazy=False):
         seznam=[]
         if size==1:
             return cls([[2**(-0.5),2**(-0.5)],[2**(-0.5),-(2**(-0.5))]])
         else:
             for i in range(size):
                 seznam.append(cls([[2**(-0.5),2**(-0.5)],[2**(-0.5),-(2**(-0.5))]]))
-        return tensor(seznam)
+        return tensor(seznam, lazy)
     
     @classmethod
-    def X(cls, size=1):
+    def X(cls, size=1, lazy=False):
         seznam=[]
         if size==1:
             return cls([[0,1],[1,0]])
         else:
             for i in range(size):
                 seznam.append(cls([[0,1],[1,0]]))
-        return tensor(seznam)
+        return tensor(seznam, lazy)
 
     @classmethod
-    def Y(cls, size=1):
+    def Y(cls, size=1, lazy=False):
         seznam=[]
         if size==1:
             return cls([[0,-1j],[0+1j,0]])
         else:
             for i in range(size):
                 seznam.append(cls([[0,-1j],[0+1j,0]]))
-        return tensor(seznam)
+        return tensor(seznam, lazy)
 
     @classmethod
-    def Z(cls, size=1):
+    def Z(cls, size=1, lazy=False):
         seznam=[]
         if size==1:
             return cls([[1,0],[0,-1]])
         else:
             for i in range(size):
                 seznam.append(cls([[1,0],[0,-1]]))
-        return tensor(seznam)
+        return tensor(seznam, lazy)
     
     @classmethod
-    def SqrtNot(cls, size=1):
+    def SqrtNot(cls, size=1, lazy=False):
         seznam=[]
         if size==1:
             return cls([[0.5*(1+1j),0.5*(1-1j)],[0.5*(1-1j),0.5*(1+1j)]])
         else:
             for i in range(size):
                 seznam.append(cls([[0.5*(1+1j),0.5*(1-1j)],[0.5*(1-1j),0.5*(1+1j)]]))
-        return tensor(seznam)
+        return tensor(seznam, lazy)
 
     @classmethod
-    def PhaseShift(cls,phase,size=1):
+    def PhaseShift(cls,phase,size=1,lazy=False):
         seznam=[]
         if size==1:
             return cls([[1,0],[0,cmath.e**(1j*(phase))]])
         else:
             for i in range(size):
                 seznam.append(cls([[1,0],[0,cmath.e**(1j*(phase))]]))
-        return tensor(seznam)
+        return tensor(seznam, lazy)
     
     @classmethod
     def QFT(cls,size=1):
         n=2**size
-        M=cls.Zero(n)
-        for i in range(n):
-            for j in range(n):
-                M[i][j]=(n**(-0.5))*(cmath.e**((i*j)*1j*2*cmath.pi/n))
-     
-        return M
+        k=np.arange(n)
+        #reduce i*j modulo n first so the phases stay exact for large n
+        return cls.from_array((n**(-0.5))*np.exp(np.outer(k, k) % n * (1j*2*cmath.pi/n)))
     
     @classmethod
     def Permutation(cls,permutation):
         P=cls.Zero(2**(len(permutation)))
-        
-        for in_v in product(range(2),repeat=len(permutation)):
-            in_v=list(in_v)
-            out=[]
-            for i in permutation:
-                out.append(str(in_v[i]))
-                
-            for i in range(len(in_v)):
-                in_v[i]=str(in_v[i])
-            
-            y=int('0b'+(''.join(in_v)),2)
-            z=int('0b'+(''.join(out)),2)
-            P[y][z]=1
+        P.data[np.arange(len(P)), _permuted_indices(permutation)]=1
                      
         return P
 
@@ -244,9 +300,411 @@ class Matrix(object):
     @classmethod
     def T(cls):
         Toffoli=cls.Id(8)
-        Toffoli.rows[6]=[0,0,0,0,0,0,0,1]
-        Toffoli.rows[7]=[0,0,0,0,0,0,1,0]
+        Toffoli[6]=[0,0,0,0,0,0,0,1]
+        Toffoli[7]=[0,0,0,0,0,0,1,0]
         return Toffoli
 
 
+#class for sparse matrices in compressed sparse row (CSR) format. It supports the same operations as
+#Matrix, so the two can be mixed freely in products and tensor products. Rows of nonzero j are
+#stored in indices/values[indptr[j]:indptr[j+1]].
+class SparseMatrix(object):
+    #builds the matrix from coordinate (COO) lists. Duplicate entries are summed up
+    def __init__(self, rows, columns, values, shape):
+        rows=np.asarray(rows, dtype=np.int64)
+        columns=np.asarray(columns, dtype=np.int64)
+        values=np.asarray(values, dtype=np.complex128)
+        if not (len(rows)==len(columns)==len(values)):
+            raise MatrixError('Coordinate lists must be of the same length.')
+        if shape[0]==0 or shape[1]==0:
+            raise MatrixError('Please specify the shape of the matrix.')
+        if len(rows) and (rows.min()<0 or rows.max()>=shape[0] or columns.min()<0 or columns.max()>=shape[1]):
+            raise MatrixError('Entry coordinates are out of bounds.')
+
+        #sort by (row, column), sum duplicates and drop explicit zeros
+        key=rows*shape[1]+columns
+        key, inverse=np.unique(key, return_inverse=True)
+        summed=np.zeros(len(key), dtype=np.complex128)
+        np.add.at(summed, inverse, values)
+        nonzero=summed!=0
+        key=key[nonzero]
+
+        self.shape=(int(shape[0]), int(shape[1]))
+        self.indices=key % shape[1]
+        self.values=summed[nonzero]
+        self.indptr=np.searchsorted(key//shape[1], np.arange(shape[0]+1)).astype(np.int64)
+
+    @classmethod
+    def from_dense(cls, M):
+        data=M.data if isinstance(M, Matrix) else np.asarray(M)
+        rows, columns=np.nonzero(data)
+        return cls(rows, columns, data[rows, columns], data.shape)
+
+    #the row index of every stored entry
+    def _row_indices(self):
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    #dense rows as python lists, for compatibility with Matrix
+    @property
+    def rows(self):
+        return self.todense().rows
+
+    def __len__(self):
+        return self.shape[0]
+
+    #returns a dense copy of the i-th row. Sparse matrices cannot be modified through item access, so the
+    #copy is read-only and M[i][j]=x raises an error instead of changing nothing
+    def __getitem__(self, i):
+        row=np.zeros(self.shape[1], dtype=np.complex128)
+        row[self.indices[self.indptr[i]:self.indptr[i+1]]]=self.values[self.indptr[i]:self.indptr[i+1]]
+        row.flags.writeable=False
+        return row
+
+    def __str__(self):
+        return str(self.todense())
+
+    def __repr__(self):
+        return "SparseMatrix: %dx%d, %d nonzero entries" % (self.shape[0], self.shape[1], self.nnz)
+
+    def __eq__(self, M):
+        if isinstance(M, Matrix):
+            return self.todense()==M
+        if not isinstance(M, SparseMatrix):
+            return NotImplemented
+        return (self.shape==M.shape and np.array_equal(self.indptr, M.indptr) and
+                np.array_equal(self.indices, M.indices) and np.array_equal(self.values, M.values))
+
+    #multiplies the matrix with a dense 2D array and returns a dense array
+    def dot(self, X):
+        if self.shape[1]!=X.shape[0]:
+            raise MatrixError('Matrix dimensions must agree.')
+        result=np.zeros((self.shape[0], X.shape[1]), dtype=np.complex128)
+        filled=np.flatnonzero(np.diff(self.indptr))
+        if len(filled):
+            products=self.values[:, None]*X[self.indices]
+            result[filled]=np.add.reduceat(products, self.indptr[filled], axis=0)
+        return result
+
+    def __mul__(self, M):
+        if isinstance(M, Matrix):
+            return Matrix.from_array(self.dot(M.data))
+        if not isinstance(M, SparseMatrix):
+            return NotImplemented
+        if self.shape[1]!=M.shape[0]:
+            raise MatrixError('Matrix dimensions must agree.')
+
+        #every stored entry (i,k) of self is combined with every stored entry (k,j) of M
+        counts=M.indptr[self.indices+1]-M.indptr[self.indices]
+        left=np.repeat(np.arange(self.nnz), counts)
+        offsets=np.arange(len(left))-np.repeat(np.cumsum(counts)-counts, counts)
+        right=M.indptr[self.indices[left]]+offsets
+        return SparseMatrix(self._row_indices()[left], M.indices[right], self.values[left]*M.values[right],
+                            (self.shape[0], M.shape[1]))
+
+    def __rmul__(self, M):
+        if not isinstance(M, Matrix):
+            return NotImplemented
+        #M*S = (S^T * M^T)^T
+        return Matrix.from_array(self.transposed().dot(M.data.T).T)
+
+    def copy(self):
+        M=SparseMatrix.__new__(SparseMatrix)
+        M.shape=self.shape
+        M.indptr=self.indptr.copy()
+        M.indices=self.indices.copy()
+        M.values=self.values.copy()
+        return M
+
+    #a new matrix object over the same arrays (see Matrix.view)
+    def view(self):
+        M=SparseMatrix.__new__(SparseMatrix)
+        M.shape, M.indptr, M.indices, M.values=self.shape, self.indptr, self.indices, self.values
+        return M
+
+    def todense(self):
+        M=Matrix.Zero(*self.shape)
+        M.data[self._row_indices(), self.indices]=self.values
+        return M
+
+    def Round(self, places):
+        return SparseMatrix(self._row_indices(), self.indices, np.round(self.values.real, places), self.shape)
+
+    def transposed(self):
+        return SparseMatrix(self.indices, self._row_indices(), self.values, (self.shape[1], self.shape[0]))
+
+    def transpose(self):
+        T=self.transposed()
+        self.shape, self.indptr, self.indices, self.values=T.shape, T.indptr, T.indices, T.values
+
+    def getConjugate(self):
+        return SparseMatrix(self.indices, self._row_indices(), self.values.conjugate(), (self.shape[1], self.shape[0]))
+
+    #costs O(nnz) for permutation-like matrices instead of a dense product
+    def isUnitary(self):
+        if self.shape[0]!=self.shape[1]:
+            return False
+        P=self*self.getConjugate()
+        rows=P._row_indices()
+        expected=(rows==P.indices).astype(np.complex128)
+        diagonal=np.zeros(self.shape[0], dtype=bool)
+        diagonal[rows[rows==P.indices]]=True
+        return diagonal.all() and np.allclose(P.values, expected, rtol=0, atol=1e-12)
+
+    def bintensor(self, M):
+        if isinstance(M, KronOperator):
+            return KronOperator([self]+M.factors)
+        if isinstance(M, Matrix):
+            M=SparseMatrix.from_dense(M)
+        p, q=M.shape
+        rows=(self._row_indices()[:, None]*p+M._row_indices()[None, :]).ravel()
+        columns=(self.indices[:, None]*q+M.indices[None, :]).ravel()
+        values=(self.values[:, None]*M.values[None, :]).ravel()
+        return SparseMatrix(rows, columns, values, (self.shape[0]*p, self.shape[1]*q))
 
+    def apply(self, matrices):
+        return self.todense().apply(matrices)
+
+    @classmethod
+    def Id(cls, size):
+        return cls(np.arange(size), np.arange(size), np.ones(size), (size, size))
+
+    @classmethod
+    def Permutation(cls, permutation):
+        n=2**(len(permutation))
+        return cls(np.arange(n), _permuted_indices(permutation), np.ones(n), (n, n))
+
+    @classmethod
+    def Cnot(cls):
+        return cls.from_dense(Matrix.Cnot())
+
+    @classmethod
+    def T(cls):
+        return cls.from_dense(Matrix.T())
+
+
+#a permutation of the qubits, equal to Matrix.Permutation(qubits) but stored as the qubit order and
+#the basis-index map only. Multiplying it with a matrix or a vector gathers rows in O(2^n) per column.
+class QubitPermutation(object):
+    def __init__(self, qubits):
+        self.qubits=list(qubits)
+        if sorted(self.qubits)!=list(range(len(self.qubits))):
+            raise MatrixError('Not a permutation of the qubits: {0}'.format(self.qubits))
+        self._index=None
+        self._inverse=None
+
+    #row y of the permutation matrix has its single 1 in column index[y]
+    @property
+    def index(self):
+        if self._index is None:
+            self._index=_permuted_indices(self.qubits)
+        return self._index
+
+    @property
+    def shape(self):
+        return (2**len(self.qubits), 2**len(self.qubits))
+
+    def __len__(self):
+        return 2**len(self.qubits)
+
+    def __getitem__(self, i):
+        row=np.zeros(len(self), dtype=np.complex128)
+        row[self.index[i]]=1
+        return row
+
+    def __repr__(self):
+        return "QubitPermutation: %s" % (self.qubits)
+
+    def __eq__(self, P):
+        if not isinstance(P, QubitPermutation):
+            return NotImplemented
+        return self.qubits==P.qubits
+
+    def dot(self, X):
+        return X[self.index]
+
+    def __mul__(self, M):
+        if isinstance(M, QubitPermutation):
+            if len(M.qubits)!=len(self.qubits):
+                raise MatrixError('Matrix dimensions must agree.')
+            return QubitPermutation([self.qubits[k] for k in M.qubits])
+        if len(M)!=len(self):
+            raise MatrixError('Matrix dimensions must agree.')
+        if isinstance(M, Matrix):
+            return Matrix.from_array(M.data[self.index])
+        if isinstance(M, SparseMatrix):
+            #row y of the result is row index[y] of M
+            inverse=self.inverse().index
+            return SparseMatrix(inverse[M._row_indices()], M.indices, M.values, M.shape)
+        return NotImplemented
+
+    def __rmul__(self, M):
+        if isinstance(M, Matrix):
+            if M.shape[1]!=len(self):
+                raise MatrixError('Matrix dimensions must agree.')
+            #column z of the result is column y of M, where index[y]=z
+            return Matrix.from_array(M.data[:, self.inverse().index])
+        if isinstance(M, SparseMatrix):
+            if M.shape[1]!=len(self):
+                raise MatrixError('Matrix dimensions must agree.')
+            return SparseMatrix(M._row_indices(), self.index[M.indices], M.values, M.shape)
+        return NotImplemented
+
+    #the inverse is cached, so that repeatedly applied permutations only build their index maps once
+    def inverse(self):
+        if self._inverse is None:
+            inverse=[0]*len(self.qubits)
+            for k, i in enumerate(self.qubits):
+                inverse[i]=k
+            self._inverse=QubitPermutation(inverse)
+            self._inverse._inverse=self
+        return self._inverse
+
+    def copy(self):
+        return QubitPermutation(self.qubits)
+
+    #a new permutation object over the same list of qubits (see Matrix.view)
+    def view(self):
+        P=QubitPermutation.__new__(QubitPermutation)
+        P.qubits, P._index, P._inverse=self.qubits, self._index, None
+        return P
+
+    def transpose(self):
+        self.qubits=self.inverse().qubits
+        self._index=None
+        self._inverse=None
+
+    def transposed(self):
+        return QubitPermutation(self.inverse().qubits)
+
+    def getConjugate(self):
+        return self.inverse()
+
+    def isUnitary(self):
+        return True
+
+    def todense(self):
+        return Matrix.Permutation(self.qubits)
+
+
+#a lazy tensor product of a list of factors. The factors are kept as they are (Matrix, SparseMatrix,
+#QubitPermutation or KronOperator) and an integer factor d stands for the d x d identity. Applying the
+#operator to a vector or a matrix goes factor by factor through reshapes, so the full product is only
+#built when todense() is called.
+class KronOperator(object):
+    def __init__(self, factors):
+        if len(factors)==0:
+            raise MatrixError('Please specify the factors of the tensor product.')
+        self.factors=list(factors)
+
+    def _factor_shape(self, factor):
+        if isinstance(factor, int):
+            return (factor, factor)
+        return factor.shape
+
+    @property
+    def shape(self):
+        rows, columns=1, 1
+        for factor in self.factors:
+            m, n=self._factor_shape(factor)
+            rows*=m
+            columns*=n
+        return (rows, columns)
+
+    def __len__(self):
+        return self.shape[0]
+
+    #returns the i-th row, computed as the tensor product of the factors' rows
+    def __getitem__(self, i):
+        digits=[]
+        for factor in reversed(self.factors):
+            m=self._factor_shape(factor)[0]
+            digits.append(i % m)
+            i//=m
+        row=np.ones(1, dtype=np.complex128)
+        for factor, d in zip(self.factors, reversed(digits)):
+            if isinstance(factor, int):
+                factor_row=np.zeros(factor, dtype=np.complex128)
+                factor_row[d]=1
+            else:
+                factor_row=factor[d]
+            row=np.kron(row, factor_row)
+        return row
+
+    @property
+    def rows(self):
+        return self.todense().rows
+
+    def __repr__(self):
+        return "KronOperator: %s" % (' x '.join('Id(%d)' % f if isinstance(f, int) else repr(f) for f in self.factors))
+
+    #multiplies the operator with a 2D numpy array, one factor at a time
+    def dot(self, X):
+        if self.shape[1]!=X.shape[0]:
+            raise MatrixError('Matrix dimensions must agree.')
+        shapes=[self._factor_shape(factor) for factor in self.factors]
+        columns=X.shape[1]
+        T=X.reshape([n for m, n in shapes]+[columns])
+        for axis, (factor, (m, n)) in enumerate(zip(self.factors, shapes)):
+            if isinstance(factor, int):
+                continue
+            T=np.moveaxis(T, axis, 0)
+            rest=T.shape[1:]
+            T=factor.dot(T.reshape(n, -1)).reshape((m,)+rest)
+            T=np.moveaxis(T, 0, axis)
+        return T.reshape(-1, columns)
+
+    def __mul__(self, M):
+        if isinstance(M, Matrix):
+            return Matrix.from_array(self.dot(M.data))
+        if isinstance(M, SparseMatrix):
+            return Matrix.from_array(self.dot(M.todense().data))
+        return NotImplemented
+
+    def __rmul__(self, M):
+        if isinstance(M, Matrix):
+            #M*K = (K^T * M^T)^T
+            return Matrix.from_array(self.transposed().dot(M.data.T).T)
+        return NotImplemented
+
+    def copy(self):
+        return KronOperator([f if isinstance(f, int) else f.copy() for f in self.factors])
+
+    #a new operator over views of the factors (see Matrix.view)
+    def view(self):
+        return KronOperator([f if isinstance(f, int) else f.view() for f in self.factors])
+
+    def todense(self):
+        T=None
+        for factor in self.factors:
+            if isinstance(factor, int):
+                factor=Matrix.Id(factor)
+            elif not isinstance(factor, Matrix):
+                factor=factor.todense()
+            T=factor if T is None else T.bintensor(factor)
+        return T
+
+    def bintensor(self, M):
+        if isinstance(M, KronOperator):
+            return KronOperator(self.factors+M.factors)
+        return KronOperator(self.factors+[M])
+
+    def Round(self, places):
+        return self.todense().Round(places)
+
+    #the factors are replaced by transposed ones rather than transposed in place, as they may be the
+    #matrices of gates
+    def transpose(self):
+        self.factors=self.transposed().factors
+
+    def transposed(self):
+        return KronOperator([f if isinstance(f, int) else f.transposed() for f in self.factors])
+
+    def getConjugate(self):
+        return KronOperator([f if isinstance(f, int) else f.getConjugate() for f in self.factors])
+
+    def isUnitary(self):
+        return all(isinstance(f, int) or f.isUnitary() for f in self.factors)
@@ -0,0 +1,165 @@
+import numpy as np
+
+# Matrix product state simulation. The state of n qbits is kept as a chain of tensors A[0], ..., A[n-1]
+# of shape (left bond, 2, right bond); the amplitude of a basis state is the product of the matrices
+# A[s][:, bit, :]. The size of the bonds grows with the entanglement between the two halves of the chain
+# they connect, so circuits that create little entanglement can be simulated for many qbits.
+#
+# The qbits move along the chain: site s holds lane lanes[s] (see Circuit.compile). A gate on k qbits
+# first swaps its qbits next to each other, then the k sites are merged into one tensor, the gate is
+# applied and the tensor is split again by singular value decompositions. Each decomposition keeps at
+# most max_bond singular values and drops the smallest ones as long as their weight stays below
+# max_error. The weight that is dropped is recorded in fidelity, the estimated overlap with the exact
+# state.
+#
+# The chain is kept in canonical form around the site center: sites left of it are left orthonormal and
+# sites right of it are right orthonormal, which makes the truncations optimal and sampling cheap.
+
+# Default largest bond dimension and largest weight of the singular values dropped at a time
+MAX_BOND = 128
+MAX_ERROR = 0.
+
+# Singular values below CUTOFF times the largest one are always dropped (they are rounding noise)
+CUTOFF = 1e-14
+
+
+class MPS(object):
+    def __init__(self, bits, max_bond=MAX_BOND, max_error=MAX_ERROR):
+        self.max_bond = max_bond
+        self.max_error = max_error
+        self.fidelity = 1.
+        self.tensors = []
+        for bit in bits:
+            A = np.zeros((1, 2, 1), dtype=np.complex128)
+            A[0, bit, 0] = 1
+            self.tensors.append(A)
+        self.lanes = list(range(len(bits)))
+        self.position = list(range(len(bits)))
+        self.center = 0
+
+    def __len__(self):
+        return len(self.tensors)
+
+    @property
+    def bond_dimensions(self):
+        return [A.shape[2] for A in self.tensors[:-1]]
+
+    # Bytes taken up by the tensors
+    @property
+    def nbytes(self):
+        return sum(A.nbytes for A in self.tensors)
+
+    # Moves the orthogonality center to site s by QR decompositions
+    def _move_center(self, s):
+        A = self.tensors
+        while self.center < s:
+            c = self.center
+            l, _, r = A[c].shape
+            Q, R = np.linalg.qr(A[c].reshape(l * 2, r))
+            A[c] = Q.reshape(l, 2, -1)
+            A[c + 1] = np.tensordot(R, A[c + 1], axes=1)
+            self.center += 1
+        while self.center > s:
+            c = self.center
+            l, _, r = A[c].shape
+            Q, R = np.linalg.qr(A[c].reshape(l, 2 * r).T)
+            A[c] = Q.T.reshape(-1, 2, r)
+            A[c - 1] = np.tensordot(A[c - 1], R.T, axes=1)
+            self.center -= 1
+
+    # Splits theta of shape (left bond, 2, rest) into the left orthonormal tensor of site s and the rest
+    def _split(self, theta, s):
+        l = theta.shape[0]
+        rest = theta.shape[2:]
+        U, S, Vh = np.linalg.svd(theta.reshape(l * 2, -1), full_matrices=False)
+
+        weights = S**2
+        total = weights.sum()
+        keep = max(1, min(self.max_bond, int(np.count_nonzero(S > CUTOFF * S[0]))))
+        # dropped[i] is the weight of the singular values i, i+1, ...
+        dropped = np.cumsum(weights[::-1])[::-1] / total
+        while keep > 1 and dropped[keep - 1] <= self.max_error:
+            keep -= 1
+        if keep < len(S):
+            self.fidelity *= 1 - dropped[keep]
+
+        S = S[:keep] * np.sqrt(total / weights[:keep].sum())
+        self.tensors[s] = U[:, :keep].reshape(l, 2, keep)
+        return (S[:, None] * Vh[:keep]).reshape((keep,) + rest)
+
+    # Applies the matrix (2^k x 2^k, port 0 is the most significant bit) to the qbits on the consecutive
+    # sites s, ..., s+k-1, taken in the order given by ports (site offsets). The sites then hold the
+    # lanes in port order.
+    def _apply_local(self, M, s, ports):
+        k = len(ports)
+        self._move_center(s)
+        theta = self.tensors[s]
+        for j in range(1, k):
+            theta = np.tensordot(theta, self.tensors[s + j], axes=1)
+        l, r = theta.shape[0], theta.shape[-1]
+        theta = theta.transpose([0] + [1 + p for p in ports] + [k + 1]).reshape(l, 2**k, r)
+        theta = np.einsum('ab,lbr->lar', M, theta).reshape((l,) + (2,) * k + (r,))
+
+        lanes = [self.lanes[s + p] for p in ports]
+        for j in range(k - 1):
+            theta = self._split(theta, s + j)
+            self.center = s + j + 1
+        self.tensors[s + k - 1] = theta.reshape(theta.shape[0], 2, r)
+        for j, lane in enumerate(lanes):
+            self.lanes[s + j] = lane
+            self.position[lane] = s + j
+
+    # Swaps the qbits on sites s and s+1
+    def _swap(self, s):
+        self._apply_local(np.eye(4, dtype=np.complex128), s, (1, 0))
+
+    # Applies a gate matrix (2^k x 2^k, port 0 is the most significant bit) to the given lanes
+    def apply(self, M, lanes):
+        M = M.todense().data if hasattr(M, 'todense') else np.asarray(M)
+        sites = [self.position[lane] for lane in lanes]
+        if len(lanes) == 1:
+            s = sites[0]
+            self.tensors[s] = np.einsum('ab,lbr->lar', M, self.tensors[s])
+            return
+
+        # The qbits are moved next to the one closest to the start of the chain, keeping their order
+        start = min(sites)
+        for j, lane in enumerate(sorted(lanes, key=self.position.__getitem__)):
+            while self.position[lane] > start + j:
+                self._swap(self.position[lane] - 1)
+        self._apply_local(M, start, [self.position[lane] - start for lane in lanes])
+
+    # Returns the state as an array with one axis per lane
+    def state(self):
+        psi = np.ones((1,), dtype=np.complex128)
+        for A in self.tensors:
+            psi = np.tensordot(psi, A, axes=1)
+        psi = psi.reshape((2,) * len(self))
+        return psi.transpose([self.position[lane] for lane in range(len(self))])
+
+    # Draws shots samples qbit by qbit without forming the state. Returns an array of the sampled bits
+    # with one row per shot and one column per lane.
+    def sample(self, shots, rng):
+        self._move_center(0)
+        n = len(self)
+        bits = np.zeros((shots, n), dtype=np.int8)
+        left = np.ones((shots, 1), dtype=np.complex128)
+        for s, A in enumerate(self.tensors):
+            branches = [left @ A[:, b, :] for b in (0, 1)]
+            weights = np.stack([np.einsum('ij,ij->i', w, w.conj()).real for w in branches], axis=1)
+            p1 = weights[:, 1] / weights.sum(axis=1)
+            chosen = rng.random(shots) < p1
+            bits[:, self.lanes[s]] = chosen
+            left = np.where(chosen[:, None], branches[1], branches[0])
+            norms = np.sqrt(np.where(chosen, weights[:, 1], weights[:, 0]))
+            left /= norms[:, None]
+        return bits
+
+
+# Simulates the circuit for the input in_v and returns the final MPS
+def simulate(circuit, in_v, max_bond=MAX_BOND, max_error=MAX_ERROR):
+    plan = circuit.compile()
+    mps = MPS(in_v, max_bond, max_error)
+    for instruction in plan.instructions:
+        mps.apply(instruction.matrix, instruction.lanes)
+    return mps
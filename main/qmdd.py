@@ -0,0 +1,306 @@
+import numpy as np
+
+# Decision diagram (QMDD) simulation. A state of n qbits is a vector of 2^n amplitudes, split in half by
+# the value of lane 0, each half split again by lane 1 and so on. Halves that are equal up to a factor
+# are stored once: a node of level l has two edges (one per value of lane l), each with a complex
+# weight and the node below it, and the amplitude of a basis state is the product of the weights along
+# its path. Gate matrices are stored the same way, with four edges per node (row bit, column bit) and
+# identity nodes on the lanes the gate does not touch.
+#
+# Nodes are normalized (the first edge of largest weight has weight 1) and hash-consed in a unique
+# table, so equal sub-diagrams are the same object. Multiplications and additions are memoized in
+# compute tables keyed by the nodes involved. States with a lot of structure (uniform superpositions,
+# the states of Grover's algorithm, basis states ...) then take a number of nodes polynomial in n.
+
+# Weights closer than TOLERANCE are considered equal, smaller ones are zero
+TOLERANCE = 1e-12
+
+# Compute tables are cleared once they have more entries
+MAX_COMPUTED = 2**20
+
+# Largest number of nodes a package creates, and the bytes a node takes up with its unique table entry
+MAX_NODES = 2**21
+NODE_BYTES = 640
+
+# Every level of a diagram adds a few frames to the recursion
+MAX_WIDTH = 200
+
+
+class Node(object):
+    __slots__ = ('level', 'edges', 'identity')
+
+    def __init__(self, level, edges, identity=False):
+        self.level = level
+        self.edges = edges
+        self.identity = identity
+
+
+# The terminal node, below the last level of every diagram
+TERMINAL = Node(None, ())
+
+ZERO = (0j, TERMINAL)
+
+
+def _quantize(w):
+    return (round(w.real / TOLERANCE), round(w.imag / TOLERANCE))
+
+
+# Unique and compute tables of the diagrams of one circuit width. Diagrams of different packages must
+# not be mixed.
+class Package(object):
+    def __init__(self, width):
+        self.width = width
+        self._unique = {}
+        self._products = {}
+        self._sums = {}
+        self._gates = {}
+        self._identities = {width: (1 + 0j, TERMINAL)}
+
+    # Number of distinct nodes created so far
+    def __len__(self):
+        return len(self._unique)
+
+    # Returns the normalized edge to the node of the given level with the given edges
+    def make(self, level, edges):
+        magnitudes = [abs(w) for w, _ in edges]
+        top = max(magnitudes)
+        if top < TOLERANCE:
+            return ZERO
+        i = next(i for i, m in enumerate(magnitudes) if m >= top - TOLERANCE)
+        norm = edges[i][0]
+        normalized = []
+        for w, node in edges:
+            w = w / norm
+            normalized.append((w, node) if abs(w) >= TOLERANCE else ZERO)
+        normalized = tuple(normalized)
+
+        key = (level,) + tuple((id(node),) + _quantize(w) for w, node in normalized)
+        node = self._unique.get(key)
+        if node is None:
+            if len(self._unique) >= MAX_NODES:
+                raise RuntimeError("The decision diagram needs more than {0} nodes.".format(MAX_NODES))
+            node = Node(level, normalized)
+            self._unique[key] = node
+        return (norm, node)
+
+    # The identity on the lanes level, ..., n-1
+    def identity(self, level):
+        if level not in self._identities:
+            below = self.identity(level + 1)
+            w, node = self.make(level, (below, ZERO, ZERO, below))
+            node.identity = True
+            self._identities[level] = (w, node)
+        return self._identities[level]
+
+    # The basis state with the given bits, one per lane
+    def basis(self, bits):
+        edge = (1 + 0j, TERMINAL)
+        for level in reversed(range(self.width)):
+            edge = self.make(level, (ZERO, edge) if bits[level] else (edge, ZERO))
+        return edge
+
+    # The diagram of a gate matrix (port 0 is the most significant bit) on the given lanes, built once
+    # per matrix and lanes
+    def gate(self, M, lanes):
+        key = (id(M), tuple(lanes))
+        if key in self._gates and self._gates[key][0] is M:
+            return self._gates[key][1]
+
+        # The ports are reordered by lane, so that the first port belongs to the topmost level
+        k = len(lanes)
+        order = sorted(range(k), key=lambda p: lanes[p])
+        data = M.todense().data.reshape((2,) * (2 * k))
+        data = data.transpose(order + [k + p for p in order]).reshape(2**k, 2**k)
+        blocks = {}
+        edge = self._block(data, sorted(lanes), 0, blocks)
+        self._gates[key] = (M, edge)
+        return edge
+
+    # The diagram from level on of the block of a gate matrix that acts on the lanes (sorted) left
+    def _block(self, block, lanes, level, blocks):
+        if not lanes:
+            if abs(block[0, 0]) < TOLERANCE:
+                return ZERO
+            w, node = self.identity(level)
+            return (complex(block[0, 0]) * w, node)
+        if not np.any(np.abs(block) >= TOLERANCE):
+            return ZERO
+        key = (level, block.tobytes())
+        if key in blocks:
+            return blocks[key]
+
+        if level == lanes[0]:
+            h = len(block) // 2
+            edges = tuple(self._block(block[r * h:(r + 1) * h, c * h:(c + 1) * h], lanes[1:], level + 1, blocks)
+                          for r in (0, 1) for c in (0, 1))
+        else:
+            below = self._block(block, lanes, level + 1, blocks)
+            edges = (below, ZERO, ZERO, below)
+        edge = self.make(level, edges)
+        blocks[key] = edge
+        return edge
+
+    # Frees the nodes of earlier states: the compute tables are cleared and the unique table keeps the
+    # nodes of the gate diagrams only. Diagrams of earlier states stay valid, but new ones do not share
+    # their nodes.
+    def collect(self):
+        self._products.clear()
+        self._sums.clear()
+        kept = set()
+        stack = [edge[1] for _, edge in self._gates.values()] + [edge[1] for edge in self._identities.values()]
+        while stack:
+            node = stack.pop()
+            if node is TERMINAL or id(node) in kept:
+                continue
+            kept.add(id(node))
+            stack.extend(child for _, child in node.edges)
+        self._unique = {key: node for key, node in self._unique.items() if id(node) in kept}
+
+    def _clear(self, table):
+        if len(table) > MAX_COMPUTED:
+            table.clear()
+
+    # Multiplies the matrix diagram m with the vector diagram v
+    def multiply(self, m, v):
+        wm, M = m
+        wv, V = v
+        if wm == 0 or wv == 0:
+            return ZERO
+        if M is TERMINAL or M.identity:
+            return (wm * wv, V)
+
+        key = (id(M), id(V))
+        result = self._products.get(key)
+        if result is None:
+            edges = tuple(self.add(self.multiply(M.edges[2 * r], V.edges[0]),
+                                   self.multiply(M.edges[2 * r + 1], V.edges[1])) for r in (0, 1))
+            result = self.make(M.level, edges)
+            self._clear(self._products)
+            self._products[key] = result
+        return (result[0] * wm * wv, result[1])
+
+    # Adds the vector diagrams x and y
+    def add(self, x, y):
+        wx, X = x
+        wy, Y = y
+        if wx == 0:
+            return y
+        if wy == 0:
+            return x
+        if X is Y:
+            w = wx + wy
+            return (w, X) if abs(w) >= TOLERANCE else ZERO
+
+        # x + y = wx (X + ratio Y), memoized for X, Y and ratio
+        ratio = wy / wx
+        key = (id(X), id(Y)) + _quantize(ratio)
+        result = self._sums.get(key)
+        if result is None:
+            edges = tuple(self.add(ex, (ratio * ey[0], ey[1])) for ex, ey in zip(X.edges, Y.edges))
+            result = self.make(X.level, edges)
+            self._clear(self._sums)
+            self._sums[key] = result
+        return (result[0] * wx, result[1])
+
+
+# The state of a circuit as a vector diagram of the given package
+class Diagram(object):
+    def __init__(self, package, edge):
+        self.package = package
+        self.edge = edge
+
+    def __len__(self):
+        return self.package.width
+
+    # Returns the distinct nodes of the diagram
+    def nodes(self):
+        seen = {}
+        stack = [self.edge[1]]
+        while stack:
+            node = stack.pop()
+            if node is TERMINAL or id(node) in seen:
+                continue
+            seen[id(node)] = node
+            stack.extend(child for _, child in node.edges)
+        return list(seen.values())
+
+    def node_count(self):
+        return len(self.nodes())
+
+    # Returns the amplitude of the basis state with the given bits, one per lane
+    def amplitude(self, bits):
+        w, node = self.edge
+        for bit in bits:
+            if w == 0:
+                return 0j
+            edge_w, node = node.edges[bit]
+            w *= edge_w
+        return complex(w)
+
+    # Returns the state as an array with one axis per lane
+    def state(self):
+        vectors = {id(TERMINAL): np.ones(1, dtype=np.complex128)}
+
+        def vector(node, size):
+            if node is TERMINAL and size > 1:
+                return np.zeros(size, dtype=np.complex128)
+            if id(node) not in vectors:
+                half = size // 2
+                vectors[id(node)] = np.concatenate([w * vector(child, half) if w != 0 else np.zeros(half, dtype=np.complex128)
+                                                    for w, child in node.edges])
+            return vectors[id(node)]
+
+        w, node = self.edge
+        n = len(self)
+        if w == 0:
+            return np.zeros((2,) * n, dtype=np.complex128)
+        return (w * vector(node, 2**n)).reshape((2,) * n)
+
+    # Squared norms of the vectors of all nodes, by node id
+    def _norms(self):
+        norms = {id(TERMINAL): 1.}
+        for node in sorted(self.nodes(), key=lambda node: -node.level):
+            norms[id(node)] = sum(abs(w)**2 * norms[id(child)] for w, child in node.edges if w != 0)
+        return norms
+
+    # Draws shots samples lane by lane from the diagram. Returns an array of the sampled bits with one
+    # row per shot and one column per lane. The nodes are numbered so that all the shots take one level
+    # at a time: each node has the probability of its 1 edge and the numbers of its children.
+    def sample(self, shots, rng):
+        norms = self._norms()
+        nodes = self.nodes() + [TERMINAL]
+        index = {id(node): i for i, node in enumerate(nodes)}
+        children = np.full((len(nodes), 2), len(nodes) - 1, dtype=np.intp)
+        ones = np.zeros(len(nodes))
+        for i, node in enumerate(nodes[:-1]):
+            (w0, c0), (w1, c1) = node.edges
+            p0 = abs(w0)**2 * norms[id(c0)] if w0 != 0 else 0.
+            p1 = abs(w1)**2 * norms[id(c1)] if w1 != 0 else 0.
+            children[i] = (index[id(c0)], index[id(c1)])
+            ones[i] = p1 / (p0 + p1)
+
+        bits = np.zeros((shots, len(self)), dtype=np.int8)
+        current = np.full(shots, index[id(self.edge[1])], dtype=np.intp)
+        for level in range(len(self)):
+            bit = rng.random(shots) < ones[current]
+            bits[:, level] = bit
+            current = children[current, bit.astype(np.intp)]
+        return bits
+
+
+# Simulates the circuit for the input in_v and returns the final state diagram. The package is kept with
+# the compiled circuit, so that its gate diagrams are built once, and the nodes of the previous state are
+# freed first.
+def simulate(circuit, in_v):
+    if len(circuit) > MAX_WIDTH:
+        raise RuntimeError("Cannot simulate {0} qbits with decision diagrams, the limit is {1}."
+                           .format(len(circuit), MAX_WIDTH))
+    plan = circuit.compile()
+    if 'qmdd' not in plan.programs:
+        plan.programs['qmdd'] = Package(len(circuit))
+    p = plan.programs['qmdd']
+    p.collect()
+    edge = p.basis(in_v)
+    for instruction in plan.instructions:
+        edge = p.multiply(p.gate(instruction.matrix, instruction.lanes), edge)
+    return Diagram(p, edge)
@@ -0,0 +1,152 @@
+from main.matrix import SparseMatrix, apply_to_axes
+import numpy as np
+
+# Sparse statevector simulation. Starting from a basis state, gates that map basis states to few basis
+# states (X, CNot, T, oracles ...) keep most amplitudes zero. Only the nonzero amplitudes are stored, as
+# an array of basis indices sorted in increasing order and an array of amplitudes; lane L is bit n-1-L
+# of the index, as in the axes of the statevector of method 3. A gate expands every stored entry into
+# the nonzero entries of the matrix column it selects, entries that land on the same index are summed
+# and amplitudes whose modulus falls below a threshold are dropped. Once more than a fraction density
+# of the 2^n amplitudes are stored, the state is turned into a dense statevector, which is cheaper from
+# then on.
+
+# Amplitudes of smaller modulus are dropped
+THRESHOLD = 1e-12
+
+# Fraction of nonzero amplitudes from which the state is kept dense
+DENSITY = 1 / 16
+
+# Basis indices are int64
+MAX_WIDTH = 62
+
+
+# The nonzero entries of a gate matrix by column: the entries of column c are rows[start[c]:start[c+1]]
+# and values[start[c]:start[c+1]]
+def _columns(M):
+    if isinstance(M, SparseMatrix):
+        rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+        columns, values = M.indices, M.values
+    else:
+        data = M.todense().data
+        rows, columns = np.nonzero(data)
+        values = data[rows, columns]
+    order = np.argsort(columns, kind='stable')
+    start = np.concatenate(([0], np.cumsum(np.bincount(columns, minlength=M.shape[1]))))
+    return start, rows[order], values[order]
+
+
+class SparseState(object):
+    # The basis state with the given bits, one per lane
+    def __init__(self, bits, threshold=THRESHOLD, density=DENSITY):
+        self.width = len(bits)
+        if self.width > MAX_WIDTH:
+            raise RuntimeError("Cannot simulate {0} qbits with a sparse state, the limit is {1}."
+                               .format(self.width, MAX_WIDTH))
+        self.threshold = threshold
+        self.density = density
+        self.index = np.array([sum(bit << (self.width - 1 - lane) for lane, bit in enumerate(bits))], dtype=np.int64)
+        self.amplitude = np.ones(1, dtype=np.complex128)
+        # The statevector (one axis per lane) once the state is dense, None before
+        self.dense = None
+
+    # Number of amplitudes stored
+    def __len__(self):
+        return 2**self.width if self.dense is not None else len(self.index)
+
+    @property
+    def nbytes(self):
+        if self.dense is not None:
+            return self.dense.nbytes
+        return self.index.nbytes + self.amplitude.nbytes
+
+    def to_dense(self):
+        if self.dense is None:
+            state = np.zeros(2**self.width, dtype=np.complex128)
+            state[self.index] = self.amplitude
+            self.dense = state.reshape((2,) * self.width)
+            self.index = self.amplitude = None
+
+    # Applies a gate matrix (port 0 is the most significant bit) to the given lanes. The columns of the
+    # matrices are kept in cache, by id, if one is given.
+    def apply(self, M, lanes, cache=None):
+        if self.dense is not None:
+            self.dense = apply_to_axes(M, self.dense, lanes)
+            return
+
+        k = len(lanes)
+        if cache is None:
+            start, rows, values = _columns(M)
+        else:
+            if id(M) not in cache:
+                cache[id(M)] = _columns(M)
+            start, rows, values = cache[id(M)]
+        shifts = [self.width - 1 - lane for lane in lanes]
+
+        # The column of the gate every entry selects, and the index with the gate's bits cleared
+        local = np.zeros(len(self.index), dtype=np.int64)
+        for p, s in enumerate(shifts):
+            local |= ((self.index >> s) & 1) << (k - 1 - p)
+        base = self.index & ~sum(1 << s for s in shifts)
+
+        # The row r of the gate sets the bits of the lanes to spread[r]
+        r = np.arange(2**k, dtype=np.int64)
+        spread = np.zeros(2**k, dtype=np.int64)
+        for p, s in enumerate(shifts):
+            spread |= ((r >> (k - 1 - p)) & 1) << s
+
+        # Every entry expands into the nonzero entries of its column
+        counts = start[local + 1] - start[local]
+        offsets = np.cumsum(counts) - counts
+        entry = np.repeat(start[local] - offsets, counts) + np.arange(counts.sum())
+        index = np.repeat(base, counts) | spread[rows[entry]]
+        amplitude = np.repeat(self.amplitude, counts) * values[entry]
+
+        order = np.argsort(index, kind='stable')
+        index, amplitude = index[order], amplitude[order]
+        first = np.flatnonzero(np.concatenate(([True], index[1:] != index[:-1])))
+        index = index[first]
+        amplitude = np.add.reduceat(amplitude, first) if len(amplitude) else amplitude
+        keep = np.abs(amplitude) >= self.threshold
+        self.index, self.amplitude = index[keep], amplitude[keep]
+
+        if len(self.index) > self.density * 2**self.width:
+            self.to_dense()
+
+    # Output values (the first output is the most significant bit) of the stored indices, where output i
+    # carries lane output[i]
+    def _outcomes(self, output):
+        n = self.width
+        outcomes = np.zeros(len(self.index), dtype=np.int64)
+        for i, lane in enumerate(output):
+            outcomes |= ((self.index >> (n - 1 - lane)) & 1) << (n - 1 - i)
+        return outcomes
+
+    # Returns the probabilities of all 2^n outputs
+    def weights(self, output):
+        if self.dense is not None:
+            return (np.abs(np.transpose(self.dense, list(output)))**2).reshape(-1)
+        weights = np.zeros(2**self.width)
+        weights[self._outcomes(output)] = np.abs(self.amplitude)**2
+        return weights
+
+    # Draws shots output values. A sparse state only draws from the stored amplitudes.
+    def sample(self, shots, rng, output):
+        if self.dense is not None:
+            outcomes, weights = None, self.weights(output)
+        else:
+            outcomes, weights = self._outcomes(output), np.abs(self.amplitude)**2
+        cumulative = np.cumsum(weights)
+        cumulative /= cumulative[-1]
+        samples = np.minimum(np.searchsorted(cumulative, rng.random(shots), side='right'), len(weights) - 1)
+        return samples if outcomes is None else outcomes[samples]
+
+
+# Simulates the circuit for the input in_v and returns the final SparseState
+def simulate(circuit, in_v, threshold=THRESHOLD, density=DENSITY):
+    plan = circuit.compile()
+    # The columns are kept with the plan, which keeps the matrices alive, so the ids stay unique
+    cache = plan.programs.setdefault('sparsestate', {})
+    state = SparseState(in_v, threshold, density)
+    for instruction in plan.instructions:
+        state.apply(instruction.matrix, instruction.lanes, cache)
+    return state
@@ -0,0 +1,301 @@
+from main.matrix import KronOperator
+from collections import deque
+import numpy as np
+
+# Stabilizer simulation of Clifford circuits (Aaronson and Gottesman, "Improved simulation of stabilizer
+# circuits"). A state of n qbits reached from a basis state by Clifford gates is described by a tableau
+# of n destabilizer and n stabilizer Pauli operators, each stored as the bits x and z of its n tensor
+# factors and a sign bit. Gates update the tableau in O(n) and measurements in O(n^2), with O(n^2) memory.
+#
+# The signs are kept as affine functions over GF(2) of the outcomes of the random measurements: a
+# row (c, a1, a2, ...) of r stands for c + a1*u1 + a2*u2 + ... where u1, u2, ... are the outcomes of the
+# first, second ... random measurement. Measuring all outputs once this way describes the whole output
+# distribution: the outputs are c + G u for uniformly random bits u, so every possible output has the
+# same probability 2^-rank(G). Sampling and exact probabilities then cost no further simulation.
+#
+# Gates are recognized by their matrices: products of single qbit Clifford gates (X, Y, Z, H, S, SqrtNot,
+# ... on any number of qbits) and CNot in either direction.
+
+
+# Single qbit Clifford gates the tableau applies directly
+_GENERATORS = {
+    'x': np.array([[0, 1], [1, 0]], dtype=np.complex128),
+    'y': np.array([[0, -1j], [1j, 0]], dtype=np.complex128),
+    'z': np.array([[1, 0], [0, -1]], dtype=np.complex128),
+    'h': np.array([[1, 1], [1, -1]], dtype=np.complex128) / np.sqrt(2),
+    's': np.array([[1, 0], [0, 1j]], dtype=np.complex128),
+}
+
+_CNOT = np.eye(4, dtype=np.complex128)[[0, 1, 3, 2]]
+_CNOT_REVERSED = np.eye(4, dtype=np.complex128)[[0, 3, 2, 1]]
+
+
+# A key of the 2x2 matrix that ignores its global phase
+def _phase_key(M):
+    flat = M.reshape(-1)
+    first = flat[np.argmax(np.abs(flat) > 1e-9)]
+    return tuple(np.round(flat * (abs(first) / first), 6).tolist())
+
+
+# All 24 single qbit Clifford gates (up to phase) as the shortest words of generators, found breadth first
+def _clifford_words():
+    words = {_phase_key(np.eye(2, dtype=np.complex128)): ()}
+    queue = deque([(np.eye(2, dtype=np.complex128), ())])
+    while queue:
+        M, word = queue.popleft()
+        for name, G in _GENERATORS.items():
+            product = G @ M
+            key = _phase_key(product)
+            if key not in words:
+                words[key] = word + (name,)
+                queue.append((product, word + (name,)))
+    return words
+
+_WORDS = _clifford_words()
+
+
+def _single(M):
+    if not np.allclose(M @ M.conj().T, np.eye(2)):
+        return None
+    return _WORDS.get(_phase_key(M))
+
+
+# Returns the tableau operations (name, ports) of a dense gate matrix (port 0 is the most significant
+# bit), or None if the matrix is not recognized as a Clifford gate
+def _decompose_dense(M):
+    k = len(M).bit_length() - 1
+    if k == 1:
+        word = _single(M)
+        return None if word is None else [(name, (0,)) for name in word]
+    if k == 2:
+        for target, ports in ((_CNOT, (0, 1)), (_CNOT_REVERSED, (1, 0))):
+            if np.allclose(M, target):
+                return [('cnot', ports)]
+
+    # Splits off the qbit of port 0 if M is a tensor product A x B: rearranged as a 4 x 4^(k-1)
+    # matrix, M then has rank one
+    rest = 2**(k - 1)
+    R = M.reshape(2, rest, 2, rest).transpose(0, 2, 1, 3).reshape(4, rest * rest)
+    i, j = np.unravel_index(np.argmax(np.abs(R)), R.shape)
+    if not np.allclose(R, np.outer(R[:, j], R[i, :]) / R[i, j]):
+        return None
+    A = R[:, j].reshape(2, 2)
+    B = R[i, :].reshape(rest, rest)
+    A = A * (np.sqrt(2) / np.linalg.norm(A))
+    B = B * (np.sqrt(rest) / np.linalg.norm(B))
+    first, others = _decompose_dense(A), _decompose_dense(B)
+    if first is None or others is None:
+        return None
+    return first + [(name, tuple(p + 1 for p in ports)) for name, ports in others]
+
+
+def _decompose(M):
+    if isinstance(M, KronOperator):
+        ops, start = [], 0
+        for factor in M.factors:
+            if isinstance(factor, int):
+                start += factor.bit_length() - 1
+                continue
+            factor_ops = _decompose(factor)
+            if factor_ops is None:
+                return None
+            ops += [(name, tuple(p + start for p in ports)) for name, ports in factor_ops]
+            start += len(factor).bit_length() - 1
+        return ops
+    return _decompose_dense(M.todense().data)
+
+
+# Returns the list of tableau operations (name, lanes) of the circuit, or None if some gate is not a
+# recognized Clifford gate. The list is kept with the compiled plan.
+def program(circuit):
+    plan = circuit.compile()
+    if 'stabilizer' not in plan.programs:
+        plan.programs['stabilizer'] = _program(plan)
+    return plan.programs['stabilizer']
+
+
+def _program(plan):
+    # The standard gates share their matrices, so each is decomposed once. The plan keeps the matrices
+    # alive, so their ids stay unique.
+    decompositions = {}
+    ops = []
+    for instruction in plan.instructions:
+        M = instruction.matrix
+        if id(M) not in decompositions:
+            decompositions[id(M)] = _decompose(M)
+        gate_ops = decompositions[id(M)]
+        if gate_ops is None:
+            return None
+        ops += [(name, tuple(instruction.lanes[p] for p in ports)) for name, ports in gate_ops]
+    return ops
+
+
+class Tableau(object):
+    # The basis state with the given bits, one per qbit
+    def __init__(self, bits):
+        n = len(bits)
+        # Rows 0..n-1 are the destabilizers, n..2n-1 the stabilizers and row 2n is scratch space
+        self.x = np.zeros((2 * n + 1, n), dtype=bool)
+        self.z = np.zeros((2 * n + 1, n), dtype=bool)
+        self.r = np.zeros((2 * n + 1, n + 1), dtype=bool)
+        self.x[np.arange(n), np.arange(n)] = True
+        self.z[np.arange(n, 2 * n), np.arange(n)] = True
+        self.variables = 0
+        for a, bit in enumerate(bits):
+            if bit:
+                self.apply('x', (a,))
+
+    def __len__(self):
+        return self.x.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.x.nbytes + self.z.nbytes + self.r.nbytes
+
+    def apply(self, name, qbits):
+        x, z, r = self.x, self.z, self.r[:, 0]
+        a = qbits[0]
+        if name == 'x':
+            r ^= z[:, a]
+        elif name == 'y':
+            r ^= x[:, a] ^ z[:, a]
+        elif name == 'z':
+            r ^= x[:, a]
+        elif name == 'h':
+            r ^= x[:, a] & z[:, a]
+            x[:, a], z[:, a] = z[:, a], x[:, a].copy()
+        elif name == 's':
+            r ^= x[:, a] & z[:, a]
+            z[:, a] ^= x[:, a]
+        elif name == 'cnot':
+            b = qbits[1]
+            r ^= x[:, a] & z[:, b] & ~(x[:, b] ^ z[:, a])
+            x[:, b] ^= x[:, a]
+            z[:, a] ^= z[:, b]
+        else:
+            raise RuntimeError("Unknown Clifford operation {0}.".format(name))
+
+    # Multiplies the rows in h (an array of row indices) by row i, keeping track of the signs
+    def _rowsum(self, h, i):
+        x1, z1 = self.x[i], self.z[i]
+        x2, z2 = self.x[h].astype(np.int8), self.z[h].astype(np.int8)
+        # Power of i picked up by every factor of the product, see Aaronson and Gottesman
+        g = np.where(x1 & z1, z2 - x2,
+                     np.where(x1, z2 * (2 * x2 - 1),
+                              np.where(z1, x2 * (1 - 2 * z2), 0)))
+        phase = (g.sum(axis=-1) % 4) // 2
+        self.r[h] ^= self.r[i]
+        self.r[h, 0] ^= phase.astype(bool)
+        self.x[h] ^= x1
+        self.z[h] ^= z1
+
+    # Measures qbit a and returns the outcome as an affine function (see r), collapsing the state
+    def measure(self, a):
+        n = len(self)
+        random = np.flatnonzero(self.x[n:2 * n, a])
+        if len(random):
+            p = n + random[0]
+            rows = np.flatnonzero(self.x[:2 * n, a])
+            self._rowsum(rows[rows != p], p)
+            self.x[p - n], self.z[p - n], self.r[p - n] = self.x[p], self.z[p], self.r[p]
+            self.variables += 1
+            self.x[p] = False
+            self.z[p] = False
+            self.z[p, a] = True
+            self.r[p] = False
+            self.r[p, self.variables] = True
+            return self.r[p].copy()
+
+        scratch = 2 * n
+        self.x[scratch] = False
+        self.z[scratch] = False
+        self.r[scratch] = False
+        for i in np.flatnonzero(self.x[:n, a]):
+            self._rowsum(scratch, n + i)
+        return self.r[scratch].copy()
+
+
+# The output distribution of a Clifford circuit: the outputs are constant + generators u (mod 2) for
+# uniformly random bits u. There is one row per output, the first output is the most significant bit.
+class Distribution(object):
+    def __init__(self, constant, generators):
+        self.constant = constant
+        self.generators = generators
+
+    def __len__(self):
+        return len(self.constant)
+
+    # Number of random bits; each of the 2^rank possible outputs has probability 2^-rank
+    @property
+    def rank(self):
+        return self.generators.shape[1]
+
+    # Returns an array of shots samples with one row of output bits per shot
+    def sample(self, shots, rng):
+        u = rng.integers(0, 2, size=(shots, self.rank), dtype=np.int64)
+        bits = (u @ self.generators.T.astype(np.int64)) & 1
+        return (bits ^ self.constant).astype(np.int8)
+
+    # Returns the exact probability that the given outputs (all of them by default) have the values in bits
+    def probability(self, bits, outputs=None):
+        outputs = list(range(len(self))) if outputs is None else list(outputs)
+        G = self.generators[outputs]
+        target = self.constant[outputs] ^ np.asarray(bits, dtype=bool)
+        rank, consistent = _solve(G, target)
+        return 2.**-rank if consistent else 0.
+
+    # Returns the probabilities of the values of the given outputs (the first one is the most significant
+    # bit), summed over the other outputs
+    def marginal(self, outputs):
+        outputs = list(outputs)
+        basis = _row_basis(self.generators[outputs].T)
+        combinations = (np.arange(2**len(basis))[:, None] >> np.arange(len(basis))) & 1
+        values = (combinations @ basis.astype(np.int64)) & 1 ^ self.constant[outputs]
+        weights = np.zeros(2**len(outputs))
+        weights[values @ (1 << np.arange(len(outputs) - 1, -1, -1))] = 2.**-len(basis)
+        return weights
+
+
+# Gaussian elimination over GF(2): returns the rank of G and whether G u = target has a solution
+def _solve(G, target):
+    A = np.concatenate([G, target[:, None]], axis=1).astype(bool)
+    rank = 0
+    for column in range(G.shape[1]):
+        pivots = np.flatnonzero(A[rank:, column])
+        if not len(pivots):
+            continue
+        p = rank + pivots[0]
+        A[[rank, p]] = A[[p, rank]]
+        others = np.flatnonzero(A[:, column])
+        A[others[others != rank]] ^= A[rank]
+        rank += 1
+    return rank, not A[rank:, -1].any()
+
+
+# Returns a basis of the space spanned by the rows of A (over GF(2))
+def _row_basis(A):
+    A = A.astype(bool)
+    rank = 0
+    for column in range(A.shape[1]):
+        pivots = np.flatnonzero(A[rank:, column])
+        if not len(pivots):
+            continue
+        p = rank + pivots[0]
+        A[[rank, p]] = A[[p, rank]]
+        others = np.flatnonzero(A[:, column])
+        A[others[others != rank]] ^= A[rank]
+        rank += 1
+    return A[:rank]
+
+
+# Simulates the Clifford circuit for the input in_v and returns its output distribution
+def simulate(circuit, in_v):
+    ops = program(circuit)
+    if ops is None:
+        raise RuntimeError("The circuit contains gates that are not Clifford gates.")
+    tableau = Tableau(in_v)
+    for name, lanes in ops:
+        tableau.apply(name, lanes)
+    forms = np.array([tableau.measure(lane) for lane in circuit.compile().output], dtype=bool)
+    forms = forms.reshape(len(circuit), len(circuit) + 1)
+    return Distribution(forms[:, 0], forms[:, 1:tableau.variables + 1])
@@ -0,0 +1,215 @@
+from collections import Counter, namedtuple
+from heapq import heappush, heappop
+import math
+import random
+import numpy as np
+
+# Tensor network simulation. Every gate on k qbits becomes a tensor with 2k indices of dimension 2: its
+# outputs and then its inputs, port 0 first, like the rows and columns of the gate matrix. Every wire
+# becomes an index shared by the tensors at its ends; the indices are labelled with the wire keys. The
+# inputs are basis vectors and the outputs are either fixed to a bit by another basis vector or left
+# open. The network is contracted two tensors at a time in an order found by a greedy search, optionally
+# improved by randomized greedy runs. Only the intermediate tensors are kept in memory, so the memory
+# needed depends on how the gates are wired (the treewidth of the circuit) instead of on 2^n.
+
+# Number of randomized greedy runs tried besides the plain greedy order
+TRIALS = 8
+
+# Largest intermediate tensor (log2 of its number of entries) that contract accepts
+MAX_WIDTH = 30
+
+# A contraction order: path lists the pairs of tensors contracted, numbering the tensors of the network
+# first and then every result in turn. flops is the number of multiplications, width the log2 of the
+# number of entries of the largest tensor.
+Contraction = namedtuple('Contraction', ['path', 'flops', 'width'])
+
+
+def _basis(bit):
+    vector = np.zeros(2, dtype=np.complex128)
+    vector[bit] = 1
+    return vector
+
+
+# Returns the tensors (array, labels) of the circuit for the input in_v. fixed maps output indices to
+# the bit the output is fixed to, the other outputs are left open. Without in_v, only the labels are
+# filled in and the arrays are None.
+def _ket(circuit, in_v=None, fixed=None):
+    fixed = fixed or {}
+    tensors = [(_basis(in_v[i]) if in_v is not None else None, (wire.key,)) for i, wire in enumerate(circuit.input)]
+    for gate in circuit.gates:
+        k = len(gate)
+        data = gate.matrix.todense().data.reshape((2,) * (2 * k)) if in_v is not None else None
+        tensors.append((data, tuple(w.key for w in gate.out_wires) + tuple(w.key for w in gate.in_wires)))
+    for i, bit in fixed.items():
+        tensors.append((_basis(bit), (circuit.output[i].key,)))
+    return tensors
+
+
+# The network of <out_v|U|in_v>, or of U|in_v> with all outputs open if out_v is None
+def network(circuit, in_v, out_v=None):
+    circuit.compile()
+    if out_v is None:
+        return _ket(circuit, in_v), tuple(wire.key for wire in circuit.output)
+    return _ket(circuit, in_v, dict(enumerate(out_v))), ()
+
+
+# The network of the probabilities of the given outputs: U|in_v> contracted with its complex conjugate.
+# The conjugate copy uses negated labels, except on the output wires, which both copies share. The
+# outputs that are asked for stay open (each index then joins three tensors), the others are summed.
+def marginal_network(circuit, in_v, outputs):
+    circuit.compile()
+    shared = {wire.key for wire in circuit.output}
+    ket = _ket(circuit, in_v)
+    bra = [(data.conj(), tuple(x if x in shared else -x for x in labels)) for data, labels in ket]
+    return ket + bra, tuple(circuit.output[i].key for i in outputs)
+
+
+# Greedy contraction order: always contracts the pair of tensors sharing an index whose result grows
+# the least compared to the pair. With rng, the choices are perturbed randomly.
+def _greedy(labels, output, rng=None):
+    tensors = {i: frozenset(l) for i, l in enumerate(labels)}
+    keep = set(output)
+    where = {}
+    for i, l in tensors.items():
+        for x in l:
+            where.setdefault(x, set()).add(i)
+
+    def result(a, b):
+        la, lb = tensors[a], tensors[b]
+        return frozenset(x for x in la | lb
+                         if x in keep or len(where[x]) > (x in la) + (x in lb))
+
+    def push(heap, a, b):
+        size = 2**len(result(a, b))
+        big = max(2**len(tensors[a]), 2**len(tensors[b]))
+        score = size - 2**len(tensors[a]) - 2**len(tensors[b])
+        if rng is not None:
+            score -= big * math.log(-math.log(rng.random() or 1e-300))
+        heappush(heap, (score, a, b))
+
+    heap = []
+    for ids in where.values():
+        ids = sorted(ids)
+        for i in range(len(ids)):
+            for j in range(i + 1, len(ids)):
+                push(heap, ids[i], ids[j])
+
+    path = []
+    flops = 0
+    width = max((len(l) for l in tensors.values()), default=0)
+    following = len(labels)
+
+    def merge(a, b):
+        nonlocal flops, width, following
+        c = result(a, b)
+        flops += 2**len(tensors[a] | tensors[b])
+        width = max(width, len(c))
+        for x in tensors[a] | tensors[b]:
+            where[x].discard(a)
+            where[x].discard(b)
+        del tensors[a], tensors[b]
+        for x in c:
+            where[x].add(following)
+        tensors[following] = c
+        path.append((a, b))
+        following += 1
+        return following - 1
+
+    while heap:
+        score, a, b = heappop(heap)
+        if a not in tensors or b not in tensors:
+            continue
+        c = merge(a, b)
+        for n in sorted({n for x in tensors[c] for n in where[x]} - {c}):
+            push(heap, c, n)
+
+    # Tensors that share no index (separate parts of the circuit) are multiplied, smallest first
+    while len(tensors) > 1:
+        a, b = sorted(tensors, key=lambda i: len(tensors[i]))[:2]
+        merge(a, b)
+
+    return Contraction(path, flops, width)
+
+
+# Finds a contraction order for tensors with the given labels (every index has dimension 2). The plain
+# greedy order is compared with trials randomized runs and the one with the fewest flops is returned.
+def contraction_order(labels, output=(), trials=TRIALS, seed=0):
+    best = _greedy(labels, output)
+    rng = random.Random(seed)
+    for _ in range(trials):
+        candidate = _greedy(labels, output, rng)
+        if candidate.flops < best.flops:
+            best = candidate
+    return best
+
+
+# Contracts the tensors (array, labels) along the path of the contraction order. Returns the array of
+# the open indices in the order given by output.
+def contract(tensors, output, contraction, max_width=MAX_WIDTH):
+    if contraction.width > max_width:
+        raise RuntimeError("Cannot contract the network: its largest tensor would have 2^{0} entries, the limit is 2^{1}."
+                           .format(contraction.width, max_width))
+
+    keep = set(output)
+    count = Counter(x for _, labels in tensors for x in set(labels))
+    arrays = dict(enumerate(tensors))
+    following = len(tensors)
+    for a, b in contraction.path:
+        (da, la), (db, lb) = arrays.pop(a), arrays.pop(b)
+        for x in set(la):
+            count[x] -= 1
+        for x in set(lb):
+            count[x] -= 1
+        lc = tuple(x for x in dict.fromkeys(la + lb) if x in keep or count[x] > 0)
+        for x in lc:
+            count[x] += 1
+        ids = {x: i for i, x in enumerate(dict.fromkeys(la + lb))}
+        arrays[following] = (np.einsum(da, [ids[x] for x in la], db, [ids[x] for x in lb], [ids[x] for x in lc]), lc)
+        following += 1
+
+    (data, labels), = arrays.values()
+    ids = {x: i for i, x in enumerate(labels)}
+    return np.einsum(data, [ids[x] for x in labels], [ids[x] for x in output])
+
+
+# Returns the contraction order of the network, kept with the compiled plan by kind of network
+def _order(circuit, kind, tensors, output, trials):
+    orders = circuit.compile().programs.setdefault('tensornet', {})
+    if (kind, trials) not in orders:
+        orders[kind, trials] = contraction_order([labels for _, labels in tensors], output, trials)
+    return orders[kind, trials]
+
+
+# Estimated contraction of the network of all output amplitudes (the one probabilities contracts)
+def estimate(circuit, trials=0):
+    circuit.compile()
+    output = tuple(wire.key for wire in circuit.output)
+    return _order(circuit, 'state', _ket(circuit), output, trials)
+
+
+# Returns the amplitudes of the outputs in out_vs (lists of bits) for the input in_v. They all use the
+# same contraction order.
+def amplitudes(circuit, in_v, out_vs, trials=TRIALS):
+    result = []
+    for out_v in out_vs:
+        tensors, output = network(circuit, in_v, out_v)
+        contraction = _order(circuit, 'amplitude', tensors, output, trials)
+        result.append(complex(contract(tensors, output, contraction)))
+    return result
+
+
+# Returns the probabilities of all 2^n outputs for the input in_v
+def probabilities(circuit, in_v, trials=TRIALS):
+    tensors, output = network(circuit, in_v)
+    contraction = _order(circuit, 'state', tensors, output, trials)
+    state = contract(tensors, output, contraction).reshape(-1)
+    return np.abs(state)**2
+
+
+# Returns the probabilities of the values of the given outputs (the first one is the most significant
+# bit) for the input in_v, summed over all the other outputs
+def marginal(circuit, in_v, outputs, trials=TRIALS):
+    outputs = tuple(outputs)
+    tensors, output = marginal_network(circuit, in_v, outputs)
+    contraction = _order(circuit, ('marginal', outputs), tensors, output, trials)
+    return contract(tensors, output, contraction).real.reshape(-1)